@@ -1,12 +1,27 @@
 #!/usr/bin/env python
 """clashogram - Clash of Clans war moniting for telegram channels."""
+import itertools
 import json
 import logging
+import os
+import sys
 
 import click
 
-from . import commands, i18n, registry, runner
+from . import (
+    api,
+    codec,
+    commands,
+    i18n,
+    metrics,
+    profiling,
+    registry,
+    runner,
+    storage,
+    tracing,
+)
 from .api import CoCAPI
+from .cache import LRUCache
 from .formatters import MessageFactory, create_standings_msg
 from .models import LeagueStandings, WarStats
 from .notifiers import DummyNotifier, TelegramNotifier
@@ -18,9 +33,40 @@ logger = logging.getLogger(__name__)
 
 @click.command()
 @click.option('--coc-token',
-              help='CoC API token. Reads COC_API_TOKEN env var.',
+              help='CoC API token, or several separated by commas.'
+                   ' Reads COC_API_TOKEN env var.',
               envvar='COC_API_TOKEN',
               prompt=True)
+@click.option('--coc-rate',
+              default=api.RATE_LIMIT,
+              type=click.FloatRange(min=0, min_open=True),
+              help='CoC requests a second, across everything the bot asks.'
+                   ' Reads COC_RATE env var.',
+              envvar='COC_RATE')
+@click.option('--coc-burst',
+              default=api.RATE_BURST,
+              type=click.IntRange(min=1),
+              help='CoC requests that may go out at once.'
+                   ' Reads COC_BURST env var.',
+              envvar='COC_BURST')
+@click.option('--clan-cache',
+              default=api.CLANINFO_MAX,
+              type=click.IntRange(min=1),
+              help='Clans whose details are kept between requests.'
+                   ' Reads CLAN_CACHE env var.',
+              envvar='CLAN_CACHE')
+@click.option('--player-cache',
+              default=api.PLAYERINFO_MAX,
+              type=click.IntRange(min=1),
+              help='Players whose details are kept between requests.'
+                   ' Reads PLAYER_CACHE env var.',
+              envvar='PLAYER_CACHE')
+@click.option('--league-war-cache',
+              default=api.LEAGUE_WARS_MAX,
+              type=click.IntRange(min=1),
+              help='Finished league wars kept decoded, 28 for each clan'
+                   ' in league. Reads LEAGUE_WAR_CACHE env var.',
+              envvar='LEAGUE_WAR_CACHE')
 @click.option('--clan-tag',
               help='Tag of clan with hash. With --chat-id, followed at'
                    ' startup. Reads COC_CLAN_TAG env var.',
@@ -48,6 +94,12 @@ logger = logging.getLogger(__name__)
               help='Let anyone ask for a clan to be followed.'
                    ' Reads OPEN_REQUESTS env var.',
               envvar='OPEN_REQUESTS')
+@click.option('--sent-retention',
+              default=14,
+              type=click.IntRange(min=3),
+              help='Days to remember what was sent about a finished war.'
+                   ' Reads SENT_RETENTION env var.',
+              envvar='SENT_RETENTION')
 @click.option('--mute-attacks',
               is_flag=True,
               help='Do not send attack updates.')
@@ -56,6 +108,12 @@ logger = logging.getLogger(__name__)
               envvar='WARLOG',
               default='warlog.db',
               type=click.Path())
+@click.option('--db-profile',
+              default=storage.PROFILE,
+              type=click.Choice(sorted(storage.PROFILES)),
+              help='How the warlog trades durability for speed.'
+                   ' Reads DB_PROFILE env var.',
+              envvar='DB_PROFILE')
 @click.option('--loglevel',
               default='WARNING',
               type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR',
@@ -64,8 +122,10 @@ logger = logging.getLogger(__name__)
 @click.option('--dryrun',
               is_flag=True,
               help='Do not save and send anything.')
-def main(coc_token, clan_tag, bot_token, chat_id, admin_id, archive,
-         open_requests, mute_attacks, warlog, loglevel, dryrun):
+def main(coc_token, coc_rate, coc_burst, clan_cache, player_cache,
+         league_war_cache, clan_tag, bot_token, chat_id, admin_id, archive,
+         open_requests, sent_retention, mute_attacks, warlog, db_profile,
+         loglevel, dryrun):
     """Publish war updates to telegram chats."""
     if loglevel:
         logging.basicConfig(level=loglevel)
@@ -83,8 +143,12 @@ def main(coc_token, clan_tag, bot_token, chat_id, admin_id, archive,
         warlog = 'dryrun.db'
         notifier = DummyNotifier()
 
-    with Storage(warlog, bootstrap_chat_id=chat_id) as db:
-        coc_api = CoCAPI(coc_token, cache=db)
+    with Storage(warlog, bootstrap_chat_id=chat_id,
+                 profile=db_profile) as db:
+        coc_api = CoCAPI(coc_token, cache=db, keep_payloads=archive,
+                         rate=coc_rate, burst=coc_burst,
+                         claninfo_max=clan_cache, playerinfo_max=player_cache,
+                         league_wars_max=league_war_cache)
         if clan_tag:
             registry.subscribe(db, clan_tag, chat_id)
 
@@ -96,37 +160,71 @@ def main(coc_token, clan_tag, bot_token, chat_id, admin_id, archive,
 
         ctx = commands.Context(db=db, monitors={}, admin_id=admin_id,
                                open_requests=open_requests, coc_api=coc_api,
-                               is_chat_admin=notifier.is_chat_admin)
+                               is_chat_admin=notifier.is_chat_admin,
+                               sent_retention=sent_retention)
+        profiling.listen()
         runner.run(ctx, build_monitor, notifier)
 
 
 @click.command()
 @click.argument('warlog_path', type=click.Path(exists=True))
 @click.argument('archive_path', type=click.Path())
-def export_wars(warlog_path, archive_path):
+@click.option('--clan', help='Only wars this clan tag fought.')
+@click.option('--against', help='Only wars against this clan tag.')
+@click.option('--result', type=click.Choice(['win', 'lose', 'draw']),
+              help='Only wars that ended so for --clan.')
+@click.option('--season', help='Only wars of this month, as YYYY-MM.')
+@click.option('--team-size', type=int, help='Only wars of this size.')
+def export_wars(warlog_path, archive_path, clan, against, result, season,
+                team_size):
     """Write the archived wars out as one json object per line."""
+    if result and not clan:
+        raise click.UsageError('--result needs --clan.')
+    filters = {'clan': clan, 'against': against, 'result': result,
+               'season': season, 'team_size': team_size}
     written = 0
-    with Storage(warlog_path) as db, \
-            open(archive_path, 'w', encoding='utf-8') as out:
-        for war_id, payload in db.archived_wars():
-            out.write(json.dumps({'war_id': war_id, 'war': payload},
-                                 ensure_ascii=False) + '\n')
+    with Storage(warlog_path) as db, open(archive_path, 'wb') as out, \
+            click.progressbar(length=db.count_wars(**filters),
+                              label='Exporting', file=sys.stderr) as bar:
+        # The war is written as it is stored, so it is never parsed. It
+        # is json already, compact and utf-8 like the line around it.
+        for war_id, text, war_tag in db.archived_json(**filters):
+            if isinstance(text, str):
+                text = text.encode('utf-8')
+            out.write(b'{"war_id":%s,"war_tag":%s,"war":%s}\n' % (
+                json.dumps(war_id).encode('utf-8'),
+                json.dumps(war_tag).encode('utf-8'), text))
             written += 1
+            bar.update(1)
     click.echo(f'Exported {written} wars.')
 
 
+# Wars written per transaction by clashogram-import-wars. Committing
+# each one would sync the disk as many times as there are wars.
+IMPORT_BATCH = 1000
+
+
 @click.command()
 @click.argument('archive_path', type=click.Path(exists=True))
 @click.argument('warlog_path', type=click.Path())
 def import_wars(archive_path, warlog_path):
     """Read back an archive written by clashogram-export."""
     read = 0
-    with Storage(warlog_path) as db, \
-            open(archive_path, encoding='utf-8') as archive:
-        for line in archive:
-            record = json.loads(line)
-            db.archive_war(record['war_id'], record['war'])
-            read += 1
+    with Storage(warlog_path) as db, open(archive_path, 'rb') as archive, \
+            click.progressbar(length=os.path.getsize(archive_path),
+                              label='Importing', file=sys.stderr) as bar:
+        while True:
+            lines = list(itertools.islice(archive, IMPORT_BATCH))
+            if not lines:
+                break
+            records = [codec.loads(line) for line in lines]
+            # Exports from before war tags were kept have none.
+            db.archive_wars(((record['war_id'], record['war'])
+                             for record in records),
+                            {record['war_id']: record.get('war_tag')
+                             for record in records})
+            read += len(records)
+            bar.update(sum(map(len, lines)))
     click.echo(f'Imported {read} wars.')
 
 
@@ -157,6 +255,15 @@ def serverless(db, coc_token, clan_tag, bot_token, chat_id):
 # Main war monitor class
 ########################################################################
 
+# Wars a monitor remembers going through: a league group has seven
+# rounds, and the clan's own war makes eight.
+UPDATED_MAX = 8
+# Finished wars a monitor remembers as delivered: every war of a league
+# group, seven rounds of four, comes back on each poll, and the clan's
+# own war with them. Older ones are looked up in `delivered` again.
+DELIVERED_MAX = 32
+
+
 class WarMonitor:
     def __init__(self, db, api, tag, notifier, chat_ids=(), archive=False):
         """Scan warlog for war updates.
@@ -182,6 +289,20 @@ class WarMonitor:
         self.msg_factory = None
         self.warstats = None
         self.leagueinfo = None
+        # When the league group was last asked for, on the wall clock,
+        # and the season whose group has been seen to end. See
+        # `runner.wants_league`.
+        self.league_checked = None
+        self.league_over = None
+        # Messages a send raised on, which the next poll will try again.
+        self.unsent = set()
+        # (war id, chats) of finished wars known to be fully delivered.
+        self.delivered = LRUCache(DELIVERED_MAX)
+        # War id to the war last gone through and what was made of it.
+        self.updated = LRUCache(UPDATED_MAX)
+        # War id to [chats, fingerprint] of the wars gone through before
+        # a restart. See `restore`.
+        self.restored = {}
         self._mute_attacks = False
 
     @property
@@ -194,35 +315,131 @@ class WarMonitor:
 
     def update(self, warinfo=None):
         if warinfo is None:
-            warinfo = self.coc_api.get_currentwar(self.clan_tag)
+            warinfo = self.coc_api.get_currentwar(self.clan_tag,
+                                                  previous=self.warinfo)
         if warinfo.is_not_in_war():
             logger.debug('Not in a war.')
             if self.warinfo is not None:
                 self.send_war_over_msg()
             self.reset()
             return
+        if warinfo.is_war_over() and self.is_delivered(warinfo):
+            return
+        if self.is_unchanged(warinfo):
+            metrics.count('unchanged')
+            return
+        if self.is_restored(warinfo):
+            # Only built, for what reads the monitor, and not walked.
+            self.populate_warinfo(warinfo)
+            self.note_updated()
+            metrics.count('unchanged')
+            return
 
         self.populate_warinfo(warinfo)
         if warinfo.is_in_preparation():
             logger.debug('War preparation.')
             self.send_preparation_msg()
+            self.note_updated()
         elif warinfo.is_in_war():
             logger.debug('In a war.')
             self.send_war_msg()
             if not self.mute_attacks:
                 self.send_attack_msgs()
+            self.note_updated()
         elif warinfo.is_war_over():
             logger.debug('War is over.')
+            registry.note_finished(self.db, self.get_war_id())
             if self.archive:
-                self.db.archive_war(self.get_war_id(), warinfo.data)
+                self.db.archive_war(self.get_war_id(), warinfo.data,
+                                    warinfo.war_tag)
             if not self.mute_attacks:
                 self.send_attack_msgs()
             self.send_war_over_msg()
             self.send_standings_msg()
+            # Reached only when no send above raised.
+            self.mark_delivered()
             self.reset()
         else:
             print("Current war status is uknown. We stay quiet.")
 
+    def _chats(self):
+        return ','.join(sorted(str(chat) for chat in self.chat_ids))
+
+    def _delivery_key(self, war_id):
+        return war_id, self._chats()
+
+    def is_delivered(self, warinfo):
+        """Whether a finished war has nothing left to send.
+
+        A league group hands back every round it has had on every poll,
+        and walking each one again costs a lookup per attack and chat.
+        Keyed by the chats as well, so a chat subscribing brings its
+        clan's finished wars back once for whatever it is owed."""
+        key = self._delivery_key(warinfo.create_war_id())
+        if self.delivered.get(key):
+            return True
+        if self.db.is_delivered(*key):
+            self.delivered.put(key, True)
+            return True
+        return False
+
+    def mark_delivered(self):
+        key = self._delivery_key(self.get_war_id())
+        self.db.mark_delivered(*key)
+        self.delivered.put(key, True)
+
+    def is_unchanged(self, warinfo):
+        """Whether this very war was gone through last time, for these
+        chats, and so has nothing new to send.
+
+        The api hands back the same object while the body it was built
+        from stays the same. What was made of it last time is put back,
+        so the commands reading the monitor see the war as it is."""
+        seen = self.updated.get(warinfo.create_war_id())
+        if seen is None or seen[0] != self._chats() or seen[1] is not warinfo:
+            return False
+        self.warinfo, self.warstats, self.msg_factory = seen[1:]
+        return True
+
+    def is_restored(self, warinfo):
+        """Whether the war is exactly as it was last gone through before
+        the restart, for the same chats. Asked once per war."""
+        seen = self.restored.pop(warinfo.create_war_id(), None)
+        return (warinfo.fingerprint is not None
+                and seen == [self._chats(), warinfo.fingerprint])
+
+    def snapshot(self):
+        """What a restart needs to carry on from here, as json.
+
+        Delivery is in the warlog already. What is not is which wars were
+        gone through as they stand, and when the league was last asked
+        for, and without them every clan would be walked and probed at
+        once on the way back up."""
+        return {
+            'league_active': self.leagueinfo is not None,
+            'league_checked': self.league_checked,
+            'league_over': self.league_over,
+            'updated': {war_id: [chats, warinfo.fingerprint]
+                        for war_id, (chats, warinfo, _, _)
+                        in self.updated.items()
+                        if warinfo.fingerprint is not None}}
+
+    def restore(self, state):
+        self.league_checked = state.get('league_checked')
+        self.league_over = state.get('league_over')
+        if state.get('league_active'):
+            # A group was under way, and nothing else says so after a
+            # restart: ask for it on the first poll.
+            self.league_checked = None
+        self.restored = dict(state.get('updated') or {})
+
+    def note_updated(self):
+        """Remember the war as gone through. Reached only when no send
+        raised, so a message still owed keeps the war from being
+        skipped."""
+        self.updated.put(self.get_war_id(), (
+            self._chats(), self.warinfo, self.warstats, self.msg_factory))
+
     def populate_warinfo(self, warinfo):
         self.warinfo = warinfo
         self.warstats = WarStats(warinfo)
@@ -301,16 +518,18 @@ class WarMonitor:
         """Post the table once per round, keyed to the round that ended."""
         if not self.leagueinfo:
             return
-        rows = LeagueStandings(self.leagueinfo).rows()
+        rows = LeagueStandings(self.leagueinfo, self.db).rows()
         if rows:
             self.send_once(lambda: create_standings_msg(rows),
                            msg_id='standings_msg', kind='standings')
 
     def reset(self):
+        self.unsent.clear()
         self.warinfo = None
         self.warstats = None
         self.msg_factory = None
 
+    @tracing.traced('monitor.send_once')
     def send_once(self, build, msg_id, kind='war'):
         """Send to every chat that has not had this message yet.
 
@@ -327,9 +546,14 @@ class WarMonitor:
                 self.mark_msg_as_sent(msg_id, chat_id)
                 continue
             i18n.activate(self.db.chat_lang(chat_id))
-            self.notifier.send(build(), chat_id)
+            with tracing.span('render'):
+                msg = build()
+            pending = (self.get_war_id(), msg_id, chat_id)
+            self.unsent.add(pending)
+            self.notifier.send(msg, chat_id)
             # Only now: a send that raised must be tried again.
             self.mark_msg_as_sent(msg_id, chat_id)
+            self.unsent.discard(pending)
 
     def send(self, msg, silent=False):
         """Tell every chat, without recording it. For news about the bot
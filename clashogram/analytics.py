@@ -0,0 +1,154 @@
+########################################################################
+# Analytics
+########################################################################
+"""Archive figures, computed a column at a time.
+
+/top reads a clan's season back from the player index: how many of its
+attacks were used and three starred, and how it did against bases
+above and below its own town hall. A season of an alliance is tens of
+thousands of attacks, so the rows are read once into columns and summed
+per key in one pass, with NumPy when it is installed and plain lists
+otherwise. Both give the same answers, to the last digit."""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Columns:
+    """Equally long columns by name: arrays under NumPy, lists
+    otherwise."""
+
+    def __init__(self, names, rows):
+        rows = list(rows)
+        self.names = names
+        self.size = len(rows)
+        self._columns = {}
+        for index, name in enumerate(names):
+            column = [row[index] for row in rows]
+            if numpy is not None:
+                column = numpy.asarray(column)
+            self._columns[name] = column
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        return self._columns[name]
+
+
+def _groups(keys):
+    """The distinct keys in the order first met, and for every row the
+    position of its key among them."""
+    if numpy is None:
+        positions, inverse, firsts = {}, [], []
+        for row, key in enumerate(keys):
+            if key not in positions:
+                positions[key] = len(positions)
+                firsts.append(row)
+            inverse.append(positions[key])
+        return list(positions), inverse, firsts
+    if not len(keys):
+        return [], numpy.zeros(0, dtype=int), []
+    distinct, firsts, inverse = numpy.unique(
+        keys, return_index=True, return_inverse=True)
+    # numpy.unique sorts its keys; the rows are wanted in the order met.
+    order = numpy.argsort(firsts, kind='stable')
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    return distinct[order].tolist(), rank[inverse], firsts[order].tolist()
+
+
+def _sum(inverse, values, count):
+    """Per group totals, added up in row order, which is what keeps the
+    floats identical to a running total."""
+    if numpy is None:
+        totals = [0] * count
+        for group, value in zip(inverse, values):
+            totals[group] += value
+        return totals
+    totals = numpy.bincount(inverse, weights=values, minlength=count)
+    if numpy.issubdtype(numpy.asarray(values).dtype, numpy.integer):
+        totals = totals.astype(int)
+    return totals.tolist()
+
+
+def _add_up(columns, key, fields, name='name'):
+    """One row per distinct `key`, in the order first met, carrying the
+    first `name` met and the totals of `fields`."""
+    keys, inverse, firsts = _groups(columns[key])
+    totals = {field: _sum(inverse, columns[field], len(keys))
+              for field in fields}
+    names = columns[name]
+    return [dict({'tag': tag, 'name': str(names[firsts[group]])},
+                 **{field: totals[field][group] for field in fields})
+            for group, tag in enumerate(keys)]
+
+
+def _ratio(part, whole):
+    return part / whole if whole else 0.0
+
+
+########################################################################
+# The archive
+########################################################################
+
+PLAYER_FIELDS = ('attacks', 'missed', 'stars', 'destruction', 'three_stars',
+                 'mirror_hits', 'wars')
+
+
+def archived_players(db, season=None, clan=None):
+    """Every player_war row the filters pick, as columns."""
+    return Columns(('tag', 'clan_tag', 'name') + PLAYER_FIELDS,
+                   db.player_war_rows(season=season, clan=clan))
+
+
+def _rates(row):
+    """Averages per attack, and the share of attacks that were used."""
+    attacks = row['attacks']
+    row['average_stars'] = _ratio(row['stars'], attacks)
+    row['average_destruction'] = _ratio(row['destruction'], attacks)
+    row['three_star_rate'] = _ratio(row['three_stars'], attacks)
+    row['mirror_rate'] = _ratio(row['mirror_hits'], attacks)
+    row['hit_rate'] = _ratio(attacks, attacks + row['missed'])
+    return row
+
+
+def clan_summary(players):
+    """Per clan totals and rates over `archived_players`, most stars
+    first. A clan's name is not in the rows, so it is named by its
+    tag."""
+    rows = _add_up(players, 'clan_tag', PLAYER_FIELDS, name='clan_tag')
+    return sorted((_rates(row) for row in rows),
+                  key=lambda row: (-row['stars'], -row['destruction']))
+
+
+def townhall_rates(db, season=None, clan=None):
+    """How attacks went by how many town hall levels the attacker had
+    over the defender, as {delta: row}. A delta below zero is a hit
+    upwards."""
+    columns = Columns(('attacker', 'defender', 'stars', 'destruction'),
+                      db.matchup_rows(season=season, clan=clan))
+    if not len(columns):
+        return {}
+    if numpy is None:
+        deltas = [a - d for a, d in zip(columns['attacker'],
+                                        columns['defender'])]
+        three = [int(stars == 3) for stars in columns['stars']]
+    else:
+        deltas = columns['attacker'] - columns['defender']
+        three = (columns['stars'] == 3).astype(int)
+    keys, inverse, _ = _groups(deltas)
+    count = len(keys)
+    attacks = _sum(inverse, [1] * len(columns) if numpy is None
+                   else numpy.ones(len(columns), dtype=int), count)
+    stars = _sum(inverse, columns['stars'], count)
+    destruction = _sum(inverse, columns['destruction'], count)
+    threes = _sum(inverse, three, count)
+    return {int(delta): {'attacks': attacks[group],
+                         'average_stars': stars[group] / attacks[group],
+                         'average_destruction':
+                             destruction[group] / attacks[group],
+                         'three_star_rate': threes[group] / attacks[group]}
+            for group, delta in sorted(enumerate(keys),
+                                       key=lambda item: item[1])}
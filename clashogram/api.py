@@ -1,11 +1,16 @@
 ########################################################################
 # CoC API Calls
 ########################################################################
-import json
+import contextlib
+import hashlib
+import logging
+import threading
 import time
 
 import requests
 
+from . import codec, metrics, tracing
+from .cache import LRUCache
 from .models import (
     ClanCapital,
     ClanInfo,
@@ -14,53 +19,181 @@ from .models import (
     WarInfo,
     WarLog,
 )
+from .ratelimit import KeyPool
 
 BASE_URL = 'https://api.clashofclans.com/v1'
 RETRIES = 3
 RETRY_AFTER = 5
 # /clan is answerable by anyone in a followed chat, so it is the one
 # command that can spend requests as fast as somebody can type. A clan's
-# name and streak do not move within a poll.
+# name and streak do not move within a poll. Followed clans and the
+# clans they are at war with are all asked about, so the cache has to
+# hold more than the followed ones alone. --clan-cache sets the size.
 CLANINFO_TTL = 60
-CLANINFO_MAX = 64
+CLANINFO_MAX = 512
+# The copy kept in the db for a restart. A rollout takes longer than a
+# TTL, and a name or streak an hour old still does for the prep
+# messages, so a restart picks up anything fetched within this.
+CLANINFO_KEEP = 60 * 60
+# Players, the same way, for --player-cache.
+PLAYERINFO_TTL = 60
+PLAYERINFO_MAX = 256
+# Finished league wars kept decoded, for --league-war-cache. A group is
+# 28 wars, and each is held once for every followed clan in it, since it
+# reads from their side. The group a monitor holds hands its own back
+# without this; it is for the first poll after the group was let go.
+LEAGUE_WARS_MAX = 256
+# Requests a second. CoC does not publish its limit, so this is an
+# estimate, and the headroom /status reports is measured against it.
+RATE_LIMIT = 10
+# Requests that may go out at once after a quiet spell.
+RATE_BURST = 10
+# The share of the burst a command leaves behind for the polls.
+COMMAND_RESERVE = 0.5
+# Seconds a key CoC refuses is left out. A key is refused for the IP it
+# was issued for, so it is not coming back until the operator acts.
+QUARANTINE = 60 * 60
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """One request under way, and what it came back with."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.body = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.body
 
 
 class CoCAPI:
-    def __init__(self, coc_token, cache=None):
-        self.coc_token = coc_token
+    def __init__(self, coc_token, cache=None, keep_payloads=False,
+                 rate=RATE_LIMIT, burst=RATE_BURST,
+                 claninfo_max=CLANINFO_MAX, playerinfo_max=PLAYERINFO_MAX,
+                 league_wars_max=LEAGUE_WARS_MAX):
+        # Several keys come comma separated, and each is limited alone.
+        tokens = (coc_token.split(',') if isinstance(coc_token, str)
+                  else [coc_token])
+        # Every request takes a token first, whoever makes it.
+        self.limiter = KeyPool([token.strip() if token else token
+                                for token in tokens], rate, burst)
+        self._local = threading.local()
+        # Requests under way, by endpoint. See `_fetch`.
+        self._flights = {}
+        self._flights_lock = threading.Lock()
         self.cache = cache
-        self._claninfo = {}
+        # Wars are read into records and their payloads let go, unless
+        # the archive is on and will want them whole.
+        self.keep_payloads = keep_payloads
+        self._claninfo = LRUCache(claninfo_max, ttl=CLANINFO_TTL)
+        self._playerinfo = LRUCache(playerinfo_max, ttl=PLAYERINFO_TTL)
+        self._league_wars = LRUCache(league_wars_max)
+        # Fetched since the last `save_claninfo`, (payload, fetched_at)
+        # by clan, so a fetch costs no write of its own.
+        self._unsaved_claninfo = {}
+        self._warm_claninfo()
+
+    def _warm_claninfo(self):
+        """Start from the clan details the last run fetched, where they
+        are recent enough.
+
+        A restart polls every clan at once, and the first prep messages
+        and commands used to ask for every clan's details on top of that.
+        Anything saved within CLANINFO_KEEP is served for a TTL after
+        the restart, and fetched again from then on as usual."""
+        if not self.cache:
+            return
+        for clan_tag, payload, _ in self.cache.fresh_claninfo(
+                time.time() - CLANINFO_KEEP):
+            self._claninfo.put(clan_tag, ClanInfo(payload))
+
+    def save_claninfo(self):
+        """Write the clan details fetched since the last call, and forget
+        the saved ones too old for a restart to use. Called with the
+        monitor snapshots rather than on every fetch."""
+        if not self.cache:
+            return
+        rows = [(clan_tag, payload, fetched_at) for clan_tag, (
+            payload, fetched_at) in self._unsaved_claninfo.items()]
+        self._unsaved_claninfo = {}
+        self.cache.save_claninfo(rows, time.time() - CLANINFO_KEEP)
 
-    def get_currentwar(self, clan_tag, war_tag=None):
-        return WarInfo(
-            self._call_api(self._get_currentwar_endpoint(clan_tag, war_tag)),
-            clan_tag, war_tag)
+    def caches(self):
+        """What this holds on to between calls, by name, for the
+        memory figures."""
+        return {'claninfo': self._claninfo, 'playerinfo': self._playerinfo,
+                'league_wars': self._league_wars}
 
-    def get_league_war(self, war_tag, clan_tag):
+    @contextlib.contextmanager
+    def answering(self):
+        """Requests made inside are for a command, and give way to the
+        polls: they wait rather than take the last tokens. Someone can
+        type /clan faster than a poll comes round, and it is the poll
+        that has a war to report."""
+        self._local.reserve = min(self.limiter.burst * COMMAND_RESERVE,
+                                  self.limiter.burst - 1)
+        try:
+            yield
+        finally:
+            self._local.reserve = 0
+
+    def get_currentwar(self, clan_tag, war_tag=None, previous=None):
+        """The war under way. `previous` is what the caller got last time,
+        and comes back as it is if the war has not moved since."""
+        return self._unless_unchanged(
+            self._get_currentwar_endpoint(clan_tag, war_tag), previous,
+            lambda payload: WarInfo(payload, clan_tag, war_tag,
+                                    keep_data=self.keep_payloads))
+
+    def get_league_war(self, war_tag, clan_tag, previous=None):
         """Fetch one war of a league group.
 
         Every war in the group is followed, not only ours, because the
         standings need all eight clans. A finished war cannot move, so
         once it has ended it is read from the warlog and never asked
-        for again."""
+        for again.
+
+        Nor is it decoded again: the WarInfo is kept, and handed out to
+        every later poll. Nothing writes to a WarInfo once built, and a
+        finished one has nothing left to change. One still being fought
+        is `previous` again for as long as it has not moved."""
+        if previous is not None and previous.is_war_over():
+            return previous
+        warinfo = self._league_wars.get((war_tag, clan_tag))
+        if warinfo is not None:
+            return warinfo
         payload = self.cache and self.cache.finished_war(war_tag)
         if payload is None:
-            payload = self._call_api(
-                self._get_currentwar_endpoint(None, war_tag))
-            if self.cache:
-                self.cache.remember_war(
-                    war_tag, payload, payload['state'] == 'warEnded')
-        return WarInfo(payload, clan_tag, war_tag)
+            warinfo = self._unless_unchanged(
+                self._get_currentwar_endpoint(None, war_tag), previous,
+                lambda payload: self._league_war(war_tag, clan_tag, payload))
+        else:
+            warinfo = WarInfo(payload, clan_tag, war_tag,
+                              keep_data=self.keep_payloads)
+        if warinfo.is_war_over():
+            self._league_wars.put((war_tag, clan_tag), warinfo)
+        return warinfo
+
+    def _league_war(self, war_tag, clan_tag, payload):
+        if self.cache:
+            self.cache.remember_war(
+                war_tag, payload, payload['state'] == 'warEnded')
+        return WarInfo(payload, clan_tag, war_tag,
+                       keep_data=self.keep_payloads)
 
     def get_claninfo(self, clan_tag):
-        now = time.monotonic()
-        fetched_at, info = self._claninfo.get(clan_tag, (0, None))
-        if info is not None and now - fetched_at < CLANINFO_TTL:
-            return info
-        info = ClanInfo(self._call_api(self._get_claninfo_endpoint(clan_tag)))
-        if len(self._claninfo) >= CLANINFO_MAX:
-            self._claninfo.clear()
-        self._claninfo[clan_tag] = (now, info)
+        info = self._claninfo.get(clan_tag)
+        if info is None:
+            payload = self._call_api(self._get_claninfo_endpoint(clan_tag))
+            if self.cache:
+                self._unsaved_claninfo[clan_tag] = (payload, time.time())
+            info = ClanInfo(payload)
+            self._claninfo.put(clan_tag, info)
         return info
 
     def get_warlog(self, clan_tag):
@@ -71,8 +204,12 @@ class CoCAPI:
             self._call_api(self._clan_endpoint(clan_tag, 'capitalraidseasons')))
 
     def get_playerinfo(self, player_tag):
-        return PlayerInfo(self._call_api(
-            f'{BASE_URL}/players/{requests.utils.quote(player_tag)}'))
+        info = self._playerinfo.get(player_tag)
+        if info is None:
+            info = PlayerInfo(self._call_api(
+                f'{BASE_URL}/players/{requests.utils.quote(player_tag)}'))
+            self._playerinfo.put(player_tag, info)
+        return info
 
     def get_warleagues(self):
         return self._call_api(f'{BASE_URL}/warleagues')['items']
@@ -81,14 +218,18 @@ class CoCAPI:
         # /leaguetiers replaced /leagues in the ranked league rework.
         return self._call_api(f'{BASE_URL}/leaguetiers')['items']
 
-    def get_currentleague(self, clan_tag, populate_wartags=True):
+    def get_currentleague(self, clan_tag, populate_wartags=True,
+                          previous=None):
+        """The clan's league group, or None. `previous` is the group the
+        caller got last time, whose wars are handed back where they have
+        not moved."""
         league_info = None
         try:
             league_info = LeagueInfo(
                 clan_tag,
                 self._call_api(self._get_currentleague_endpoint(clan_tag)))
             if populate_wartags:
-                league_info.populate_wartags(self)
+                league_info.populate_wartags(self, previous)
         except requests.HTTPError as err:
             # 404 is how the server says the clan is in no league group.
             if err.response.status_code != 404:
@@ -96,14 +237,97 @@ class CoCAPI:
         return league_info
 
     def _call_api(self, endpoint):
+        return codec.loads(self._fetch(endpoint))
+
+    def _unless_unchanged(self, endpoint, previous, build):
+        """What `build` makes of the endpoint's payload, or `previous` if
+        it was built from the very same body.
+
+        A war moves every few minutes and is polled every minute, so most
+        polls get back exactly the bytes they got before. Hashing them
+        costs a fraction of decoding them, and handing back the very same
+        object is what lets the monitor see there is nothing to do.
+
+        The last object is the caller's to keep, not a cache's here: the
+        clans are polled in turn, and a cache smaller than all of them
+        would have dropped each before it came round again."""
+        body = self._fetch(endpoint)
+        fingerprint = hashlib.blake2b(body, digest_size=16).hexdigest()
+        if previous is not None and previous.fingerprint == fingerprint:
+            return previous
+        built = build(codec.loads(body))
+        built.fingerprint = fingerprint
+        return built
+
+    def _fetch(self, endpoint):
+        """The body at `endpoint`, asked for once however many callers
+        want it at the same time.
+
+        Two chats asking /clan together, or two prep messages wanting the
+        same clan, would otherwise each spend a request on the same bytes.
+        The first caller makes the request and the rest wait for it, and
+        get its body or its error. Bodies are bytes, so sharing one is
+        safe; each caller decodes its own."""
+        with self._flights_lock:
+            flight = self._flights.get(endpoint)
+            leading = flight is None
+            if leading:
+                flight = self._flights[endpoint] = _Flight()
+        if not leading:
+            metrics.count('coc.coalesced')
+            return flight.wait()
+        try:
+            flight.body = self._request(endpoint)
+        except BaseException as err:
+            flight.error = err
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[endpoint]
+            flight.done.set()
+        return flight.body
+
+    @tracing.traced('coc')
+    def _request(self, endpoint):
         for _ in range(RETRIES):
+            with tracing.span('throttle'):
+                key = self.limiter.take(getattr(self._local, 'reserve', 0))
+            metrics.mark('coc')
+            metrics.mark(f'coc.key{key.index}')
             res = requests.get(endpoint,
-                    headers={'Authorization': f'Bearer {self.coc_token}'})
-            if res.status_code != requests.codes.too_many_requests:
+                    headers={'Authorization': f'Bearer {key.token}'})
+            if res.status_code == requests.codes.too_many_requests:
+                self.limiter.quarantine(key, self._retry_after(res))
+                if not self.limiter.usable():
+                    time.sleep(self._retry_after(res))
+            elif self._refused(res) and len(self.limiter.keys) > 1:
+                logger.warning('CoC refused key %s, leaving it out.',
+                               key.index)
+                metrics.count(f'coc.key{key.index}.refused')
+                self.limiter.quarantine(key, QUARANTINE)
+                if not self.limiter.usable():
+                    break
+            else:
                 break
-            time.sleep(self._retry_after(res))
         res.raise_for_status()
-        return json.loads(res.content.decode('utf-8'))
+        return res.content
+
+    def _refused(self, res):
+        """Whether a 403 is about the key rather than what was asked.
+        A private warlog is a 403 too, and no other key would help."""
+        if res.status_code != requests.codes.forbidden:
+            return False
+        try:
+            body = codec.loads(res.content)
+        except ValueError:
+            return False
+        # A proxy in front of CoC may answer with anything.
+        if not isinstance(body, dict):
+            return False
+        # CoC sends "message": null at times.
+        return (body.get('reason') == 'accessDenied.invalidIp'
+                or (body.get('message') or '').startswith(
+                    'Invalid authorization'))
 
     def _retry_after(self, res):
         return int(res.headers.get('Retry-After', RETRY_AFTER))
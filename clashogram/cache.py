@@ -0,0 +1,71 @@
+########################################################################
+# Caching
+########################################################################
+"""A bounded map that forgets what was used longest ago.
+
+The instance runs for months, so anything kept between polls has to
+stop growing somewhere. functools.lru_cache would do for a function,
+but these caches are filled from more than one place and read by the
+memory figures, so they are objects.
+
+Each one counts its hits, misses and evictions, which is what tells a
+cache too small for the instance from one that is merely busy."""
+import collections
+import threading
+import time
+
+
+class LRUCache:
+    """At most `maxsize` entries, each good for `ttl` seconds if given.
+
+    An entry past its time is a miss, and is dropped when found."""
+
+    def __init__(self, maxsize, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._items = collections.OrderedDict()
+        # Commands and polls may share one, see `CoCAPI._fetch`.
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                stored_at, value = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and self._clock() - stored_at >= self.ttl:
+                del self._items[key]
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (self._clock(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def items(self):
+        """Every (key, value), coldest first, stale or not. Reading them
+        counts as neither a hit nor a miss."""
+        with self._lock:
+            return [(key, value) for key, (_, value) in self._items.items()]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
@@ -0,0 +1,44 @@
+########################################################################
+# Json
+########################################################################
+"""Decoding json, with whatever is fastest among what is installed.
+
+Every followed clan has a whole war parsed every minute, so decoding is
+most of what a poll costs in CPU. orjson decodes the fixtures in data/
+about three times as fast as the standard library, as measured by
+scripts/bench_json.py.
+It is optional, and without it nothing changes but the speed.
+
+Every decoder here takes bytes as they came off the wire, and a str as
+sqlite hands it back."""
+import json
+
+
+def _stdlib(data):
+    # Given bytes, json.loads sniffs which utf they are before decoding.
+    # CoC only ever sends utf-8, and saying so is measurably quicker.
+    return json.loads(data.decode('utf-8') if isinstance(data, bytes)
+                      else data)
+
+
+DECODERS = {'json': _stdlib}
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    DECODERS['orjson'] = orjson.loads
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    DECODERS['ujson'] = ujson.loads
+
+# Fastest first.
+PREFERENCE = ('orjson', 'ujson', 'json')
+
+name = next(candidate for candidate in PREFERENCE if candidate in DECODERS)
+loads = DECODERS[name]
@@ -13,11 +13,22 @@ service can drive it unchanged."""
 import dataclasses
 import datetime
 import html
+import time
 
 import requests
 
-from . import i18n, registry
+from . import (
+    analytics,
+    api,
+    i18n,
+    memory,
+    metrics,
+    profiling,
+    registry,
+    tracing,
+)
 from .formatters import (
+    create_attack_rates_msg,
     create_player_stats_msg,
     create_standings_msg,
     create_unused_attacks_msg,
@@ -48,6 +59,11 @@ class Context:
     open_requests: bool = False
     coc_api: object = None
     is_chat_admin: object = None
+    # When each clan is next polled, on the monotonic clock. The runner's,
+    # kept here so /status can tell how far off the next one is.
+    due: dict = dataclasses.field(default_factory=dict)
+    # Days a finished war's delivery records are kept.
+    sent_retention: int = 14
 
 
 def handle(ctx, event):
@@ -127,6 +143,8 @@ def answer(ctx, chat_id, from_id, text, chat_type='', from_name=''):
     # contact, so it is the one command that has to answer for the bot.
     if name in ('help', 'start'):
         return [Answer(chat_id, _usage(ctx, chat_id, from_id, chat_type))]
+    if name in ARCHIVE_COMMANDS:
+        return ARCHIVE_COMMANDS[name](ctx, chat_id, args)
 
     handler = WAR_COMMANDS.get(name)
     if handler is None:
@@ -234,6 +252,8 @@ PUBLIC_MENU = (
     ('mirror', N_('Who is facing whom')),
     ('standings', N_('The league table')),
     ('stats', N_('League attack stats')),
+    ('top', N_('The season\'s best attackers')),
+    ('player', N_('A player\'s war record')),
     ('clan', N_('The clan itself')),
     ('leaders', N_('Who runs the clan')),
     ('donors', N_('Who has given the most')),
@@ -253,6 +273,10 @@ OPERATOR_MENU = (
     ('operators', N_('Who may operate')),
     ('addoperator', N_('Let somebody help')),
     ('removeoperator', N_('Stop letting them')),
+    ('status', N_('How the instance is doing')),
+    ('slow', N_('The slowest recent polls')),
+    ('profile', N_('Profile the next polls')),
+    ('memory', N_('What each clan costs to hold')),
 )
 
 
@@ -349,6 +373,8 @@ def _usage(ctx, chat_id, from_id, chat_type=''):
             _('  /missing    who still has attacks'),
             _('  /standings  the league table'),
             _('  /stats      league attack stats'),
+            _('  /top [SEASON]       the season\'s best attackers'),
+            _('  /player PLAYER_TAG  a player\'s war record'),
             _('  /clan       the clan itself'),
             _('  /leaders    who runs it'),
             _('  /left       how long the war has to run'),
@@ -387,7 +413,11 @@ def _usage(ctx, chat_id, from_id, chat_type=''):
                   _('  /follow CLAN_TAG           follow a clan here'),
                   _('  /unfollow CLAN_TAG         stop following here'),
                   _('  /add CLAN_TAG [CHAT]       follow one in CHAT'),
-                  _('  /remove CLAN_TAG [CHAT]    stop following')]
+                  _('  /remove CLAN_TAG [CHAT]    stop following'),
+                  _('  /status                    how the instance is doing'),
+                  _('  /slow                      the slowest recent polls'),
+                  _('  /profile [CYCLES]          profile the next polls'),
+                  _('  /memory [trace|stop]       what each clan costs to hold')]
         # Advertising them while nobody can file one describes a
         # workflow that cannot happen.
         if _requests_open(ctx):
@@ -420,14 +450,15 @@ def _cmd_missing(monitor):
 def _cmd_standings(monitor):
     if monitor.leagueinfo is None:
         return _('Not in a league war.')
-    return create_standings_msg(LeagueStandings(monitor.leagueinfo).rows())
+    return create_standings_msg(
+        LeagueStandings(monitor.leagueinfo, monitor.db).rows())
 
 
 def _cmd_stats(monitor):
     if monitor.leagueinfo is None:
         return _('Not in a league war.')
     return create_player_stats_msg(
-        LeaguePlayerStats(monitor.leagueinfo).rows())
+        LeaguePlayerStats(monitor.leagueinfo, monitor.db).rows())
 
 
 def _cmd_left(monitor):
@@ -498,6 +529,71 @@ WAR_COMMANDS = {
 }
 
 
+########################################################################
+# Archive commands
+########################################################################
+
+def _cmd_player(ctx, chat_id, args):
+    """Only the wars played for a clan followed in the chat, so a chat
+    cannot read through the archive of every clan the instance keeps."""
+    if not args:
+        return [Answer(chat_id, _('Usage: /player PLAYER_TAG'))]
+    followed = registry.clans_for_chat(ctx.db, chat_id)
+    if not followed:
+        return [Answer(chat_id, _('No clan followed here yet.'))]
+    tag = _normalise(args[0])
+    totals = ctx.db.player_totals(tag, clans=followed)
+    if totals is None:
+        return [Answer(chat_id, _('No archived war has {tag} in it.').format(
+            tag=_safe(tag)))]
+    wars = ctx.db.player_wars(tag, clans=followed)
+    lines = [f'{_safe(wars[0]["name"])} {_safe(tag)}',
+             _('{wars} wars, {attacks} attacks, {missed} missed').format(
+                 **totals),
+             _('{stars} stars, {three_stars} of them three, '
+               '{mirror_hits} on their mirror').format(**totals)]
+    if totals['attacks']:
+        lines.append(_('Average destruction {average:.1f}%').format(
+            average=totals['destruction'] / totals['attacks']))
+    recent = '\n'.join(
+        f'{(war["end_time"] or "")[:8]: <9}{war["stars"]: >2}★ '
+        f'{war["destruction"]: >4.0f}% {war["attacks"]}/'
+        f'{war["attacks"] + war["missed"]}' for war in wars)
+    return [Answer(chat_id, '\n'.join(lines) + f'\n<pre>{recent}</pre>')]
+
+
+def _cmd_top(ctx, chat_id, args):
+    """Over the archive, so it covers every war of the month rather
+    than the league group alone, and is empty without --archive."""
+    followed = registry.clans_for_chat(ctx.db, chat_id)
+    if not followed:
+        return [Answer(chat_id, _('No clan followed here yet.'))]
+    season = args[0] if args else datetime.datetime.now(
+        datetime.timezone.utc).strftime('%Y-%m')
+    parts = []
+    for clan_tag in followed:
+        rows = ctx.db.season_leaders(clan_tag, season)
+        text = (_season_msg(ctx.db, clan_tag, season, rows) if rows else
+                _('Nothing archived for {season}.').format(
+                    season=_safe(season)))
+        parts.append(text if len(followed) == 1 else f'{clan_tag}\n{text}')
+    return [Answer(chat_id, '\n\n'.join(parts))]
+
+
+def _season_msg(db, clan_tag, season, rows):
+    """The leaders, then how the whole clan attacked."""
+    clan, = analytics.clan_summary(
+        analytics.archived_players(db, season=season, clan=clan_tag))
+    return '\n'.join((create_player_stats_msg(rows), create_attack_rates_msg(
+        clan, analytics.townhall_rates(db, season=season, clan=clan_tag))))
+
+
+ARCHIVE_COMMANDS = {
+    'player': _cmd_player,
+    'top': _cmd_top,
+}
+
+
 ########################################################################
 # Operator commands
 ########################################################################
@@ -634,6 +730,125 @@ def _resolve(ctx, chat_id, args, approved):
             Answer(request['chat_id'], told.format(clan=clan))]
 
 
+def _cmd_status(ctx, chat_id, args):
+    """How the instance is doing, from what it already keeps in memory.
+    Nothing here asks CoC or Telegram anything."""
+    grouped = registry.clans_with_chats(ctx.db)
+    chats = {chat for listed in grouped.values() for chat in listed}
+    polls = [trace.duration for trace in tracing.recent]
+    rate = metrics.per_minute('coc')
+    limit = (ctx.coc_api.limiter.rate if ctx.coc_api is not None
+             else api.RATE_LIMIT)
+    unsent = sum(len(m.unsent) for m in ctx.monitors.values())
+    rss = metrics.rss()
+    lines = [
+        _('Clans {clans}, chats {chats}').format(clans=len(grouped),
+                                                  chats=len(chats)),
+        _('Polls {average:.2f}s average, {p95:.2f}s p95').format(
+            average=sum(polls) / len(polls) if polls else 0.0,
+            p95=metrics.percentile(polls, 0.95)),
+        _('CoC {rate} requests a minute, {spare} to spare').format(
+            rate=rate, spare=max(0, int(limit * 60) - rate))]
+    lines += _key_lines(ctx)
+    lines += [
+        _('Unchanged polls skipped {count}').format(
+            count=metrics.counters['unchanged']),
+        _('Telegram {count} messages waiting').format(count=unsent),
+        _('Warlog {size}, memory {rss}').format(
+            size=_megabytes(ctx.db.size()),
+            rss=_megabytes(rss) if rss is not None else '?')]
+    if ctx.due:
+        lines.append(_('Next clan due in {seconds}s').format(
+            seconds=max(0, int(min(ctx.due.values()) - time.monotonic()))))
+    return [Answer(chat_id, '\n'.join(lines))]
+
+
+def _key_lines(ctx):
+    """A line per CoC key, when there is more than one to compare."""
+    if ctx.coc_api is None or len(ctx.coc_api.limiter.keys) < 2:
+        return []
+    usable = ctx.coc_api.limiter.usable()
+    return [(_('Key {index}: {rate} requests a minute') if key in usable
+             else _('Key {index}: {rate} requests a minute, left out')).format(
+                index=key.index, rate=metrics.per_minute(f'coc.key{key.index}'))
+            for key in ctx.coc_api.limiter.keys]
+
+
+def _megabytes(size):
+    return f'{size / 2 ** 20:.1f} MB'
+
+
+def _cmd_slow(ctx, chat_id, args):
+    """The slowest polls still remembered, and what each spent its
+    time on. Read from memory, so asking costs nothing."""
+    traces = tracing.slowest()
+    if not traces:
+        return [Answer(chat_id, _('Nothing polled yet.'))]
+    return [Answer(chat_id, '\n\n'.join(
+        f'{_safe(trace.label)} {trace.duration:.2f}s '
+        f'{time.strftime("%H:%M:%S", time.gmtime(trace.started))}\n'
+        f'{_safe(trace.breakdown())}' for trace in traces))]
+
+
+def _cmd_profile(ctx, chat_id, args):
+    if args and not args[0].isdigit():
+        return [Answer(chat_id, _('Usage: /profile [CYCLES]'))]
+    cycles = int(args[0]) if args else profiling.CYCLES
+    if not cycles:
+        return [Answer(chat_id, _('Usage: /profile [CYCLES]'))]
+    running = profiling.is_running()
+    left = profiling.request(cycles)
+    if running:
+        return [Answer(chat_id, _('Already profiling, {cycles} cycles to go. '
+                                  'I will say where the file went.').format(
+            cycles=left))]
+    return [Answer(chat_id, _('Profiling the next {cycles} cycles. I will '
+                              'say where the file went.').format(
+        cycles=left))]
+
+
+def _cmd_memory(ctx, chat_id, args):
+    if args and args[0] == 'trace':
+        if not memory.is_tracing():
+            memory.start_trace()
+            return [Answer(chat_id, _('Tracing allocations. Ask /memory '
+                                      'trace again to see what grew.'))]
+        grown = memory.trace_diff()
+        if not grown:
+            return [Answer(chat_id, _('Nothing grew.'))]
+        return [Answer(chat_id, '\n'.join(
+            f'{size:+d} B {count:+d} {_safe(where)}'
+            for where, size, count in grown))]
+    if args and args[0] == 'stop':
+        if memory.is_tracing():
+            memory.stop_trace()
+        return [Answer(chat_id, _('Not tracing allocations.'))]
+    if args:
+        return [Answer(chat_id, _('Usage: /memory [trace|stop]'))]
+    seen = set()
+    sizes = sorted(((tag, memory.monitor_sizes(monitor, seen))
+                    for tag, monitor in ctx.monitors.items()),
+                   key=lambda item: -item[1]['total'])
+    lines = [_('{clan} war {war}, league {league}').format(
+        clan=_safe(tag), war=_kilobytes(size['war']),
+        league=_kilobytes(size['league'])) for tag, size in sizes[:10]]
+    if ctx.coc_api is not None:
+        lines += [_('Cache {name} {size}, {hits} hits, {misses} misses, '
+                    '{evictions} evicted').format(
+            name=name, size=_kilobytes(memory.deep_size(cache, seen)),
+            hits=cache.hits, misses=cache.misses, evictions=cache.evictions)
+            for name, cache in ctx.coc_api.caches().items()]
+    rss = metrics.rss()
+    lines.append(_('Clans {total} in all, process {rss}').format(
+        total=_kilobytes(sum(size['total'] for _tag, size in sizes)),
+        rss=_megabytes(rss) if rss is not None else '?'))
+    return [Answer(chat_id, '\n'.join(lines))]
+
+
+def _kilobytes(size):
+    return f'{size / 2 ** 10:.0f} kB'
+
+
 def _cmd_operators(ctx, chat_id, args):
     names = ctx.db.person_names()
     def label(user_id):
@@ -679,6 +894,10 @@ ADMIN_COMMANDS = {
     'requests': _cmd_requests,
     'approve': _cmd_approve,
     'deny': _cmd_deny,
+    'status': _cmd_status,
+    'slow': _cmd_slow,
+    'profile': _cmd_profile,
+    'memory': _cmd_memory,
 }
 
 
@@ -32,6 +32,23 @@ def create_player_stats_msg(rows):
     return "<pre>" + msg + "</pre>"
 
 
+def create_attack_rates_msg(clan, townhalls):
+    """A clan's season over the archive, from `analytics.clan_summary`
+    and `analytics.townhall_rates`."""
+    msg = "🎯" + _(" Attacks")
+    msg += "\n▪️" + _("{attacks} used, {missed} missed, "
+                      "{three:.0f}% three stars").format(
+        three=clan['three_star_rate'] * 100, **clan)
+    if townhalls:
+        msg += "\n▪️" + _("Town hall lead, attacks, stars, three stars")
+    for delta, row in townhalls.items():
+        msg += "\n▫️{delta: <+3d} {attacks: <4} {average_stars:.2f} " \
+               "{three: >3.0f}%".format(delta=delta,
+                                       three=row['three_star_rate'] * 100,
+                                       **row)
+    return "<pre>" + msg + "</pre>"
+
+
 def create_unused_attacks_msg(members):
     if not members:
         return _('Everyone has attacked.')
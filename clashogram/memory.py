@@ -0,0 +1,93 @@
+########################################################################
+# Memory
+########################################################################
+"""What each followed clan costs to hold.
+
+The deployment caps the pod's memory, and what grows with the number of
+clans is the war payloads every monitor holds on to. These figures are
+for sizing that cap and for spotting a leak before the pod is killed
+for it, so they are approximate by design: sys.getsizeof summed over
+everything an object reaches, each object counted once."""
+import sys
+import tracemalloc
+import types
+
+# Walking into these would count the interpreter rather than the data.
+_OPAQUE = (type, types.ModuleType, types.FunctionType, types.MethodType,
+           types.BuiltinFunctionType)
+
+_baseline = None
+
+
+def deep_size(obj, seen=None):
+    """Bytes held by `obj` and whatever it reaches that `seen` lacks.
+
+    Passing one `seen` through several calls counts what they share
+    once, against whichever was asked first."""
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if item is None or id(item) in seen or isinstance(item, _OPAQUE):
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif isinstance(item, (str, bytes, int, float, bool)):
+            continue
+        else:
+            if hasattr(item, '__dict__'):
+                stack.append(vars(item))
+            for cls in type(item).__mro__:
+                for name in getattr(cls, '__slots__', ()):
+                    stack.append(getattr(item, name, None))
+    return total
+
+
+def monitor_sizes(monitor, seen=None):
+    """The current war and the league group a monitor holds.
+
+    A league war is also the current war while it is being played, so
+    the war is counted first and the league gets what is left. The
+    monitor's api, storage and notifier are shared by every clan and
+    are not walked into."""
+    seen = set() if seen is None else seen
+    seen.update(id(shared) for shared in
+                (monitor.coc_api, monitor.db, monitor.notifier))
+    war = deep_size(monitor.warinfo, seen)
+    league = deep_size(monitor.leagueinfo, seen)
+    return {'war': war, 'league': league, 'total': war + league}
+
+
+def start_trace():
+    """Begin tracing allocations and remember where they stand now."""
+    global _baseline
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _baseline = tracemalloc.take_snapshot()
+
+
+def is_tracing():
+    return _baseline is not None
+
+
+def trace_diff(limit=10):
+    """Where memory grew since `start_trace`, biggest first, as
+    (place, bytes grown, blocks grown)."""
+    if _baseline is None:
+        return []
+    stats = tracemalloc.take_snapshot().compare_to(_baseline, 'lineno')
+    return [(str(stat.traceback), stat.size_diff, stat.count_diff)
+            for stat in stats[:limit]]
+
+
+def stop_trace():
+    """Tracing slows every allocation, so it is not left running."""
+    global _baseline
+    _baseline = None
+    tracemalloc.stop()
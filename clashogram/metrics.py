@@ -0,0 +1,68 @@
+########################################################################
+# Metrics
+########################################################################
+"""Counters kept in memory for the operator to ask about.
+
+Nothing here is exported or scraped. The instance is run over Telegram,
+so the figures are read by a command, and reading them must not cost a
+request to anybody."""
+import collections
+import os
+import sys
+import time
+
+counters = collections.Counter()
+_events = collections.defaultdict(collections.deque)
+WINDOW = 60
+
+
+def count(name, amount=1):
+    counters[name] += amount
+
+
+def mark(name):
+    """Note that something happened now, to be counted per minute."""
+    counters[name] += 1
+    events = _events[name]
+    events.append(time.monotonic())
+    _forget(events)
+
+
+def per_minute(name):
+    events = _events[name]
+    _forget(events)
+    return len(events)
+
+
+def _forget(events):
+    horizon = time.monotonic() - WINDOW
+    while events and events[0] < horizon:
+        events.popleft()
+
+
+def percentile(values, fraction):
+    """Nearest rank, which is plenty for a few hundred polls."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def rss():
+    """Resident memory in bytes, or None where it cannot be read.
+
+    /proc is current but Linux only. getrusage is the fallback and gives
+    the peak rather than the current figure, which is still the number a
+    memory limit cares about. Windows has neither."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes, except on macOS where it is bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
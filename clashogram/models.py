@@ -1,6 +1,11 @@
 ########################################################################
 # Models according to CoC API
 ########################################################################
+import functools
+import sys
+
+from .tracing import traced
+
 
 class ClanInfo:
     def __init__(self, clandata):
@@ -63,126 +68,236 @@ class ClanInfo:
         return self.data['isWarLogPublic']
 
 
+class Record:
+    """A war payload entry, kept in slots and read like the dict it was.
+
+    The formatters and the stats index members and attacks by their
+    payload names, so a record answers to those names as a mapping
+    does. A field the payload left out reads as missing, not as None.
+    Anything the bot never reads is not kept at all."""
+    __slots__ = ()
+
+    def __init__(self, data):
+        for name in self.__slots__:
+            setattr(self, name, data.get(name))
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        value = getattr(self, key) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def keys(self):
+        return [name for name in self.__slots__
+                if getattr(self, name) is not None]
+
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self)!r})'
+
+
+def _tag(tag):
+    # The same few dozen tags recur in every attack of every war.
+    return sys.intern(tag) if tag else tag
+
+
+class Attack(Record):
+    __slots__ = ('attackerTag', 'defenderTag', 'destructionPercentage',
+                 'duration', 'order', 'stars')
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.attackerTag = _tag(self.attackerTag)
+        self.defenderTag = _tag(self.defenderTag)
+
+
+class Member(Record):
+    __slots__ = ('attacks', 'bestOpponentAttack', 'mapPosition', 'name',
+                 'opponentAttacks', 'tag', 'townhallLevel')
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.tag = _tag(self.tag)
+        if self.bestOpponentAttack is not None:
+            self.bestOpponentAttack = Attack(self.bestOpponentAttack)
+        if self.attacks is not None:
+            self.attacks = tuple(Attack(a) for a in self.attacks)
+
+
+class Side(Record):
+    """One clan's half of a war.
+
+    The members are read into records at once. Keeping the payload's own
+    list until they were asked for held on to nearly all of the payload,
+    for every war in a league group the standings only add up. What is
+    left lazy is the lookups by tag, see `WarInfo._indexes`."""
+    __slots__ = ('attacks', 'clanLevel', 'destructionPercentage', 'members',
+                 'name', 'stars', 'tag')
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.tag = _tag(self.tag)
+        self.members = tuple(Member(m) for m in data.get('members') or ())
+
+
 class WarInfo:
-    def __init__(self, wardata, clan_tag=None, war_tag=None):
-        self.data = wardata
+    def __init__(self, wardata, clan_tag=None, war_tag=None,
+                 keep_data=False):
+        """Read a war payload into records.
+
+        A league group's twenty eight wars are held for the whole
+        season, and the payload as parsed json is several times the
+        size of what is read from it. So it is let go once read, unless
+        `keep_data` says somebody will want it whole, which only the
+        archive does."""
+        self.data = wardata if keep_data else None
         self.war_tag = war_tag
+        self.state = wardata['state']
+        self.team_size = wardata.get('teamSize')
+        self.start_time = wardata.get('startTime')
+        self.end_time = wardata.get('endTime')
+        self.preparation_start_time = wardata.get('preparationStartTime')
+        self.battle_modifier = wardata.get('battleModifier')
+        self._attacks_per_member = wardata.get('attacksPerMember')
+        self.clan = Side(wardata['clan'])
+        self.opponent = Side(wardata['opponent'])
         self.us, self.them = self._take_sides(clan_tag)
-        self.clan_members = {}
-        self.opponent_members = {}
-        self.players = {}
-        self.ordered_attacks = None
-        self._populate()
+        # A hash of the body this was read from, set by the api, which is
+        # how a restarted monitor knows a war is where it left it.
+        self.fingerprint = None
 
     def _take_sides(self, clan_tag):
         """Find which slot we occupy.
 
         A regular war always puts us in `clan`, but a league war names
         the two sides arbitrarily, so we may be either one."""
-        if clan_tag and self.data['opponent'].get('tag') == clan_tag:
-            return 'opponent', 'clan'
-        return 'clan', 'opponent'
-
-    @property
-    def state(self):
-        return self.data['state']
+        if clan_tag and self.opponent.tag == clan_tag:
+            return self.opponent, self.clan
+        return self.clan, self.opponent
 
     @property
     def clan_tag(self):
-        return self.data[self.us]['tag']
+        return self.us['tag']
 
     @property
     def op_tag(self):
-        return self.data[self.them]['tag']
+        return self.them['tag']
 
     @property
     def clan_name(self):
-        return self.data[self.us]['name']
+        return self.us['name']
 
     @property
     def op_name(self):
-        return self.data[self.them]['name']
+        return self.them['name']
 
     @property
     def clan_level(self):
-        return self.data[self.us]['clanLevel']
+        return self.us['clanLevel']
 
     @property
     def op_level(self):
-        return self.data[self.them]['clanLevel']
+        return self.them['clanLevel']
 
     @property
     def clan_destruction(self):
-        return self.data[self.us]['destructionPercentage']
+        return self.us['destructionPercentage']
 
     @property
     def op_destruction(self):
-        return self.data[self.them]['destructionPercentage']
+        return self.them['destructionPercentage']
 
     @property
     def clan_stars(self):
-        return self.data[self.us]['stars']
+        return self.us['stars']
 
     @property
     def op_stars(self):
-        return self.data[self.them]['stars']
+        return self.them['stars']
 
     @property
     def clan_attacks(self):
-        return self.data[self.us]['attacks']
+        return self.us['attacks']
 
     @property
     def op_attacks(self):
-        return self.data[self.them]['attacks']
-
-    @property
-    def start_time(self):
-        return self.data['startTime']
-
-    @property
-    def end_time(self):
-        return self.data['endTime']
+        return self.them['attacks']
 
     def mirrors(self):
         """Each of our members against the base facing them.
 
         The mirror is the opponent holding the same map position, which
         is the base a member is expected to hit."""
-        theirs = {m['mapPosition']: m
-                  for m in self.data[self.them]['members']}
+        theirs = {m['mapPosition']: m for m in self.them.members}
         pairs = []
-        for member in sorted(self.data[self.us]['members'],
+        for member in sorted(self.us.members,
                              key=lambda m: m['mapPosition']):
             facing = theirs.get(member['mapPosition'])
             pairs.append((member['mapPosition'], member['name'],
                           facing['name'] if facing else ''))
         return pairs
 
-    @property
-    def team_size(self):
-        return self.data['teamSize']
-
     @property
     def attacks_per_member(self):
         # League wars give everyone a single attack and do not always say so.
         if self.war_tag:
             return 1
-        return self.data.get('attacksPerMember', 2)
+        return self._attacks_per_member or 2
 
-    def _populate(self):
+    @property
+    def clan_members(self):
+        return self._indexes[0]
+
+    @property
+    def opponent_members(self):
+        return self._indexes[1]
+
+    @property
+    def players(self):
+        return self._indexes[2]
+
+    @property
+    def ordered_attacks(self):
+        return self._indexes[3]
+
+    @functools.cached_property
+    def _indexes(self):
+        """Members by tag and attacks by order, built on first use.
+
+        The members themselves are records from the start, see `Side`.
+        A war that is only counted towards the standings never asks for
+        these, and never pays for the dicts or the sort."""
+        clan_members, opponent_members, players = {}, {}, {}
         if self.is_not_in_war():
-            return
-        for member in self.data[self.us]['members']:
-            self.clan_members[member['tag']] = member
-            self.players[member['tag']] = member
-        for opponent in self.data[self.them]['members']:
-            self.opponent_members[opponent['tag']] = opponent
-            self.players[opponent['tag']] = opponent
-        self.ordered_attacks = self.get_ordered_attacks()
+            return clan_members, opponent_members, players, None
+        for member in self.us.members:
+            clan_members[member['tag']] = member
+            players[member['tag']] = member
+        for opponent in self.them.members:
+            opponent_members[opponent['tag']] = opponent
+            players[opponent['tag']] = opponent
+        ordered_attacks = self._order_attacks(players)
+        # A defender's best attack is one of the attacks already read, so
+        # the record is shared rather than held twice.
+        for player in players.values():
+            best = player.bestOpponentAttack
+            if best is not None and best.order in ordered_attacks:
+                player.bestOpponentAttack = ordered_attacks[best.order][1]
+        return clan_members, opponent_members, players, ordered_attacks
 
     def get_ordered_attacks(self):
+        return self._order_attacks(self.players)
+
+    def _order_attacks(self, players):
         ordered_attacks = {}
-        for player in self.players.values():
+        for player in players.values():
             for attack in self.get_player_attacks(player):
                 ordered_attacks[attack['order']] = (player, attack)
         return ordered_attacks
@@ -199,44 +314,43 @@ class WarInfo:
         return self.players[tag]
 
     def is_not_in_war(self):
-        return self.data['state'] == 'notInWar'
+        return self.state == 'notInWar'
 
     def is_in_preparation(self):
-        return self.data['state'] == 'preparation'
+        return self.state == 'preparation'
 
     def is_in_war(self):
-        return self.data['state'] == 'inWar'
+        return self.state == 'inWar'
 
     def is_war_over(self):
-        return self.data['state'] == 'warEnded'
+        return self.state == 'warEnded'
 
     def is_hard_mode(self):
-        return self.data.get('battleModifier') == 'hardMode'
+        return self.battle_modifier == 'hardMode'
 
     def is_clan_member(self, player):
         return player['tag'] in self.clan_members
 
     def is_participant(self, clan_tag):
-        return clan_tag in (self.data['clan'].get('tag'),
-                            self.data['opponent'].get('tag'))
+        return clan_tag in (self.clan.tag, self.opponent.tag)
 
     def is_win(self):
-        if self.data[self.us]['stars'] != self.data[self.them]['stars']:
-            return self.data[self.us]['stars'] > self.data[self.them]['stars']
-        return (self.data[self.us]['destructionPercentage'] >
-                self.data[self.them]['destructionPercentage'])
+        if self.us['stars'] != self.them['stars']:
+            return self.us['stars'] > self.them['stars']
+        return (self.us['destructionPercentage'] >
+                self.them['destructionPercentage'])
 
     def is_draw(self):
         return \
-            self.data[self.us]['stars'] == self.data[self.them]['stars'] and\
-            (self.data[self.us]['destructionPercentage'] == self.data[self.them]['destructionPercentage'])
+            self.us['stars'] == self.them['stars'] and\
+            (self.us['destructionPercentage'] == self.them['destructionPercentage'])
 
     def create_war_id(self):
         # Keyed on the payload's own slot order, never on ours, so that the
         # same war yields one id no matter which clan is asking.
-        return "{}{}{}".format(self.data['clan']['tag'],
-                               self.data['opponent']['tag'],
-                               self.data['preparationStartTime'])
+        return "{}{}{}".format(self.clan['tag'],
+                               self.opponent['tag'],
+                               self.preparation_start_time)
 
 
 class LeagueInfo:
@@ -291,6 +405,19 @@ class LeagueInfo:
     def rounds(self):
         return self.data['rounds']
 
+    @property
+    def group_key(self):
+        """What names this group within its season. CoC gives a group a
+        tag, but not always, and its clans name it just as well."""
+        return self.data.get('tag') or ','.join(
+            sorted(clan['tag'] for clan in self.data.get('clans', ())))
+
+    @property
+    def group(self):
+        """The season and group, which is what league totals are kept
+        under."""
+        return self.data.get('season') or '', self.group_key
+
     @property
     def our_wartags(self):
         return {wartag: warinfo for wartag, warinfo in self._wartags.items() if warinfo.is_participant(self.clan_tag)}
@@ -299,13 +426,17 @@ class LeagueInfo:
     def wartags(self):
         return self._wartags
 
-    def populate_wartags(self, api):
+    @traced('league.populate_wartags')
+    def populate_wartags(self, api, previous=None):
+        """Fetch every war of the group. The wars of `previous`, the same
+        group as last fetched, are handed back where unchanged."""
+        earlier = previous._wartags if previous is not None else {}
         for rnd in self.rounds:
             for war_tag in rnd['warTags']:
                 if war_tag == '#0':
                     continue
                 self._wartags[war_tag] = api.get_league_war(
-                    war_tag, self.clan_tag)
+                    war_tag, self.clan_tag, previous=earlier.get(war_tag))
 
     def reset(self):
         self._wartags.clear()
@@ -338,80 +469,132 @@ class LeagueInfo:
     def is_war_over(self):
         return self.data['state'] == 'warEnded'
 
+    def is_ended(self):
+        """The group's own state, which says the whole league is over
+        rather than one of its wars."""
+        return self.data.get('state') == 'ended'
+
+
+def fold_league(db, leagueinfo):
+    """Add the group's newly finished wars to its totals in `db`.
+
+    A finished war cannot move, so it is counted once, ever, and the
+    tables are read back rather than recounted. Every clan and every
+    player of the group is folded, so clans followed in the same group
+    share the work."""
+    season, group = leagueinfo.group
+    folded = db.folded_league_wars(season, group)
+    for war_tag, warinfo in leagueinfo.wartags.items():
+        if war_tag in folded or not warinfo.is_war_over():
+            continue
+        db.fold_league_war(
+            season, group, war_tag, list(LeagueStandings.tally(warinfo)),
+            [dict(row, clan_tag=side['tag'])
+             for side in (warinfo.clan, warinfo.opponent)
+             for row in LeaguePlayerStats.tally(warinfo, side)])
+
 
 class LeagueStandings:
     """Cumulative results for every clan in a league group.
 
     A league war hands the winner ten bonus stars, and those are what
-    order the table rather than the stars earned in the attacks."""
+    order the table rather than the stars earned in the attacks.
+
+    Given a warlog, the finished wars are folded into it once, and the
+    table is read from there."""
 
     BONUS_STARS = 10
 
-    def __init__(self, leagueinfo):
+    def __init__(self, leagueinfo, db=None):
         self.leagueinfo = leagueinfo
+        self.db = db
 
     def rows(self):
-        totals = {}
-        for warinfo in self.leagueinfo.wartags.values():
-            if not warinfo.is_war_over():
-                continue
-            winner = self._winning_side(warinfo.data)
-            for side in ('clan', 'opponent'):
-                clan = warinfo.data[side]
-                row = totals.setdefault(clan['tag'],
-                                        {'tag': clan['tag'],
-                                         'name': clan['name'],
-                                         'stars': 0,
-                                         'destruction': 0.0,
-                                         'rounds': 0})
-                row['stars'] += clan['stars']
-                if side == winner:
-                    row['stars'] += self.BONUS_STARS
-                row['destruction'] += clan['destructionPercentage']
-                row['rounds'] += 1
+        if self.db is not None:
+            fold_league(self.db, self.leagueinfo)
+            totals = self.db.league_clans(*self.leagueinfo.group)
+        else:
+            totals = {}
+            for warinfo in self.leagueinfo.wartags.values():
+                if warinfo.is_war_over():
+                    _add_up(totals, self.tally(warinfo))
         for row in totals.values():
             # Averaged, because a running total past 100% reads as a bug.
             row['destruction'] /= row['rounds']
         return sorted(totals.values(),
                       key=lambda row: (-row['stars'], -row['destruction']))
 
-    def _winning_side(self, data):
+    @classmethod
+    def tally(cls, warinfo):
+        """What one finished war adds to each of its clans' rows."""
+        winner = cls._winning_side(warinfo)
+        for clan in (warinfo.clan, warinfo.opponent):
+            yield {'tag': clan['tag'],
+                   'name': clan['name'],
+                   'stars': clan['stars'] + (
+                       cls.BONUS_STARS if clan is winner else 0),
+                   'destruction': float(clan['destructionPercentage']),
+                   'rounds': 1}
+
+    @staticmethod
+    def _winning_side(warinfo):
+        clan, opponent = warinfo.clan, warinfo.opponent
         for field in ('stars', 'destructionPercentage'):
-            if data['clan'][field] != data['opponent'][field]:
-                return ('clan' if data['clan'][field] > data['opponent'][field]
-                        else 'opponent')
+            if clan[field] != opponent[field]:
+                return clan if clan[field] > opponent[field] else opponent
         return None
 
 
+def _add_up(totals, rows):
+    """Sum rows into `totals` by tag, each keeping the name it came with
+    first."""
+    for row in rows:
+        total = totals.get(row['tag'])
+        if total is None:
+            totals[row['tag']] = dict(row)
+            continue
+        for field, value in row.items():
+            if field not in ('tag', 'name'):
+                total[field] += value
+
+
 class LeaguePlayerStats:
-    """Per player totals across the league rounds our clan has played."""
+    """Per player totals across the league rounds our clan has played.
 
-    def __init__(self, leagueinfo):
+    Given a warlog, the finished rounds are read from what
+    `fold_league` kept, and only the round under way is counted here."""
+
+    def __init__(self, leagueinfo, db=None):
         self.leagueinfo = leagueinfo
+        self.db = db
 
     def rows(self):
         totals = {}
+        if self.db is not None:
+            fold_league(self.db, self.leagueinfo)
+            totals = self.db.league_players(*self.leagueinfo.group,
+                                            self.leagueinfo.clan_tag)
         for warinfo in self.leagueinfo.our_wartags.values():
-            if not (warinfo.is_in_war() or warinfo.is_war_over()):
-                continue
-            for tag, member in warinfo.clan_members.items():
-                attacks = warinfo.get_player_attacks(member)
-                row = totals.setdefault(tag, {'tag': tag,
-                                              'name': member['name'],
-                                              'stars': 0,
-                                              'destruction': 0.0,
-                                              'attacks': 0,
-                                              'missed': 0,
-                                              'rounds': 0})
-                row['attacks'] += len(attacks)
-                row['missed'] += warinfo.attacks_per_member - len(attacks)
-                row['stars'] += sum(a['stars'] for a in attacks)
-                row['destruction'] += sum(a['destructionPercentage']
-                                          for a in attacks)
-                row['rounds'] += 1
+            if warinfo.is_in_war() or (warinfo.is_war_over()
+                                       and self.db is None):
+                _add_up(totals, self.tally(warinfo, warinfo.us))
         return sorted(totals.values(),
                       key=lambda row: (-row['stars'], -row['destruction']))
 
+    @staticmethod
+    def tally(warinfo, side):
+        """What one war adds to the rows of one side's players."""
+        for member in side.members:
+            attacks = warinfo.get_player_attacks(member)
+            yield {'tag': member['tag'],
+                   'name': member['name'],
+                   'stars': sum(a['stars'] for a in attacks),
+                   'destruction': float(sum(a['destructionPercentage']
+                                            for a in attacks)),
+                   'attacks': len(attacks),
+                   'missed': warinfo.attacks_per_member - len(attacks),
+                   'rounds': 1}
+
 
 def unused_attacks(warinfo):
     """Who still has attacks left, for answering rather than announcing."""
@@ -487,8 +670,9 @@ class WarStats:
         info['op_stars'] = 0
         info['clan_used_attacks'] = 0
         info['op_used_attacks'] = 0
+        ordered_attacks = self.warinfo.ordered_attacks
         for order in range(1, attack_order + 1):
-            player, attack = self.warinfo.ordered_attacks[order]
+            player, attack = ordered_attacks[order]
             if self.warinfo.is_clan_member(player):
                 info['clan_destruction'] +=\
                     self.get_attack_new_destruction(attack)
@@ -526,13 +710,17 @@ class WarStats:
             return 0
 
     def get_best_attack_destruction_upto(self, in_attack):
+        # Attributes rather than subscripts: this runs for every attack
+        # against every attack before it, and the records are slots.
+        defender, attacker = in_attack['defenderTag'], in_attack['attackerTag']
+        ordered_attacks = self.warinfo.ordered_attacks
         best_score = 0
         for order in range(1, in_attack['order'] + 1):
-            _, attack = self.warinfo.ordered_attacks[order]
-            if attack['defenderTag'] == in_attack['defenderTag'] and\
-               attack['destructionPercentage'] > best_score and\
-               attack['attackerTag'] != in_attack['attackerTag']:
-                best_score = attack['destructionPercentage']
+            _, attack = ordered_attacks[order]
+            if attack.defenderTag == defender and\
+               attack.destructionPercentage > best_score and\
+               attack.attackerTag != attacker:
+                best_score = attack.destructionPercentage
         return best_score
 
     def get_attack_new_stars(self, attack):
@@ -544,11 +732,13 @@ class WarStats:
             return 0
 
     def get_best_attack_stars_upto(self, in_attack):
+        defender, attacker = in_attack['defenderTag'], in_attack['attackerTag']
+        ordered_attacks = self.warinfo.ordered_attacks
         best_score = 0
         for order in range(1, in_attack['order'] + 1):
-            _, attack = self.warinfo.ordered_attacks[order]
-            if attack['defenderTag'] == in_attack['defenderTag'] and\
-               attack['stars'] > best_score and\
-               attack['attackerTag'] != in_attack['attackerTag']:
-                best_score = attack['stars']
+            _, attack = ordered_attacks[order]
+            if attack.defenderTag == defender and\
+               attack.stars > best_score and\
+               attack.attackerTag != attacker:
+                best_score = attack.stars
         return best_score
@@ -7,6 +7,8 @@ import time
 
 import requests
 
+from .tracing import traced
+
 # Statuses that mean the bot is in the chat and can post there.
 PRESENT = ('member', 'administrator', 'creator')
 
@@ -49,6 +51,7 @@ class TelegramNotifier:
         self.offset = None
         self._api = f'https://api.telegram.org/bot{bot_token}'
 
+    @traced('telegram')
     def send(self, msg, chat_id, silent=False):
         endpoint = "https://api.telegram.org/bot{bot_token}/sendMessage?"\
                    "parse_mode={mode}&chat_id={chat_id}&text={text}"\
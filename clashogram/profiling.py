@@ -0,0 +1,89 @@
+########################################################################
+# Profiling
+########################################################################
+"""Profile the running loop, without restarting it.
+
+The operator asks for a window of poll cycles, with /profile or by
+sending the process SIGUSR1, and the cycles that follow run under
+cProfile. The result is written next to the warlog as a pstats file,
+which is what snakeviz, flameprof and friends read.
+
+Only the polling half of a cycle is profiled. The other half waits on
+Telegram for commands and would bury everything else in socket reads."""
+import contextlib
+import cProfile
+import dataclasses
+import logging
+import os
+import signal
+import time
+
+CYCLES = 5
+MAX_CYCLES = 100
+
+logger = logging.getLogger(__name__)
+_left = 0
+_profiler = None
+
+
+@dataclasses.dataclass
+class Cycle:
+    """Where the profile went, once the window it closed was written."""
+    written: str = None
+
+
+def request(cycles=CYCLES):
+    """Profile the next `cycles` cycles. Asking again while a window is
+    open leaves it with whichever is more, what it had left or what was
+    asked for, so it never adds the two. Returns the cycles it now has
+    left."""
+    global _left
+    _left = max(_left, min(cycles, MAX_CYCLES))
+    return _left
+
+
+def listen():
+    """Open a window on SIGUSR1, where the platform has one."""
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: request())
+
+
+def is_running():
+    """Whether a window is open, asked for or already under way."""
+    return bool(_left) or _profiler is not None
+
+
+@contextlib.contextmanager
+def cycle(warlog):
+    global _left, _profiler
+    done = Cycle()
+    if _left and _profiler is None:
+        _profiler = cProfile.Profile()
+    if _profiler is None:
+        yield done
+        return
+    try:
+        _profiler.enable()
+    except ValueError as err:
+        # Another profiler already holds the interpreter.
+        logger.warning('Cannot profile (%s).', err)
+        _left, _profiler = 0, None
+        yield done
+        return
+    try:
+        yield done
+    finally:
+        _profiler.disable()
+        _left -= 1
+        if not _left:
+            done.written = _write(_profiler, warlog)
+            _profiler = None
+
+
+def _write(profiler, warlog):
+    path = os.path.join(
+        os.path.dirname(os.path.abspath(warlog)),
+        time.strftime('profile-%Y%m%dT%H%M%S.pstats', time.gmtime()))
+    profiler.dump_stats(path)
+    logger.warning('Profile written to %s.', path)
+    return path
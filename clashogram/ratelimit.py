@@ -0,0 +1,112 @@
+########################################################################
+# Rate limiting
+########################################################################
+"""Spending requests no faster than CoC allows.
+
+Waiting for a 429 and sleeping on it finds the limit by crossing it,
+and each time the whole loop stops while it sleeps. A token bucket
+stays under the limit instead, and a burst of polls due together still
+goes out at once as long as the bucket has the tokens.
+
+An instance with several keys has a bucket for each, since CoC limits
+every key on its own."""
+import threading
+import time
+
+
+class TokenBucket:
+    """`rate` tokens a second, holding at most `burst`.
+
+    A caller may ask to leave some tokens behind. Commands do, so they
+    never use up what the polls were going to spend."""
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(burst)
+        self._stamp = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def take(self, reserve=0):
+        """Wait until a token can be had with `reserve` still left, and
+        take it. Returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1 + reserve:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 + reserve - self._tokens) / self.rate
+            # Slept outside the lock, so other callers can check too.
+            self._sleep(wait)
+            waited += wait
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+
+class Key:
+    """One CoC token and its bucket."""
+
+    def __init__(self, index, token, bucket):
+        self.index = index
+        self.token = token
+        self.bucket = bucket
+        self.until = 0.0
+
+    def __repr__(self):
+        # Never the token: this ends up in logs.
+        return f'<Key {self.index}>'
+
+
+class KeyPool:
+    """Several keys spent as one budget.
+
+    Each request goes out on the key with the most tokens left, so the
+    load spreads by what every key can still afford rather than in turn.
+    A key CoC throttles or refuses is set aside for a while and the
+    others carry on. With every key set aside the one back soonest is
+    used anyway: waiting on it quietly would only hide the error."""
+
+    def __init__(self, tokens, rate, burst, clock=time.monotonic,
+                 sleep=time.sleep):
+        self._clock = clock
+        self.keys = [Key(index, token,
+                         TokenBucket(rate, burst, clock=clock, sleep=sleep))
+                     for index, token in enumerate(tokens, start=1)]
+        self.burst = burst
+
+    @property
+    def rate(self):
+        return sum(key.bucket.rate for key in self.keys)
+
+    def usable(self):
+        now = self._clock()
+        return [key for key in self.keys if key.until <= now]
+
+    def take(self, reserve=0):
+        """Wait for a token on the best key, and return the key."""
+        usable = self.usable()
+        if usable:
+            key = max(usable, key=lambda key: key.bucket.available())
+        else:
+            key = min(self.keys, key=lambda key: key.until)
+        key.bucket.take(reserve)
+        return key
+
+    def quarantine(self, key, seconds):
+        key.until = self._clock() + seconds
+
+    def available(self):
+        return sum(key.bucket.available() for key in self.usable())
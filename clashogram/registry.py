@@ -47,6 +47,17 @@ def subscribe(db, clan_tag, chat_id, war_id=None):
         db.mark_sent(war_id, msg_id, chat_id)
 
 
+def note_finished(db, war_id):
+    db.note_finished(war_id, _now())
+
+
+def retire_sent(db, days):
+    """Forget what was sent for the wars over for more than `days`."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return db.retire_sent(
+        (now - datetime.timedelta(days=days)).isoformat(), now.isoformat())
+
+
 def unsubscribe(db, clan_tag, chat_id):
     return db.unsubscribe(clan_tag, chat_id)
 
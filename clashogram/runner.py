@@ -6,18 +6,26 @@
 `WarMonitor` used to own the loop, which worked while there was one of
 them. A single long poll cannot be run once per monitor, so the loop
 lives here instead and the monitors are asked in turn."""
+import contextlib
 import datetime
 import logging
+import signal
 import time
 
 import requests
 
-from . import commands, i18n, registry
+from . import commands, i18n, profiling, registry, tracing
 from .i18n import gettext_ as _
 
 POLL_INTERVAL = 60
 IDLE_TICK = 1
 BACKOFF = POLL_INTERVAL * 10
+RETAIN_EVERY = 60 * 60
+SNAPSHOT_EVERY = 5 * 60
+# League week starts on the first of the month and is over well before
+# this day. Outside it a clan is asked about a group this rarely.
+LEAGUE_WINDOW = 12
+LEAGUE_PROBE = 6 * 60 * 60
 logger = logging.getLogger(__name__)
 
 
@@ -45,36 +53,119 @@ def publish_menu(ctx, notifier):
 def run(ctx, build_monitor, notifier):
     """Poll every followed clan and answer whoever asks, forever."""
     publish_menu(ctx, notifier)
-    due = {}
-    while True:
-        sync(ctx, build_monitor, due)
-        now = time.monotonic()
-        for clan_tag, monitor in list(ctx.monitors.items()):
-            if due.get(clan_tag, 0) <= now:
-                due[clan_tag] = time.monotonic() + poll(
-                    ctx, monitor, notifier)
-        deadline = min(due.values(), default=time.monotonic() + IDLE_TICK)
-        answer_until(ctx, notifier, deadline)
+    due = ctx.due
+    # A rollout stops the process with SIGTERM. Leaving by SystemExit
+    # runs the finally below, which is what saves the monitors.
+    previous = signal.signal(signal.SIGTERM, _terminate)
+    try:
+        while True:
+            with profiling.cycle(ctx.db.path) as cycle:
+                sync(ctx, build_monitor, due)
+                now = time.monotonic()
+                for clan_tag, monitor in list(ctx.monitors.items()):
+                    if due.get(clan_tag, 0) <= now:
+                        with tracing.poll(clan_tag):
+                            due[clan_tag] = time.monotonic() + poll(
+                                ctx, monitor, notifier)
+                retain(ctx)
+                snapshot(ctx)
+            if cycle.written:
+                _say(ctx, notifier, _('Profile written to {path}.').format(
+                    path=cycle.written))
+            deadline = min(due.values(),
+                           default=time.monotonic() + IDLE_TICK)
+            answer_until(ctx, notifier, deadline)
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        snapshot(ctx, force=True)
+
+
+def _terminate(signum, frame):
+    raise SystemExit(0)
 
 
 def sync(ctx, build_monitor, due):
     """Bring the monitors in line with the subscriptions.
 
     New clans are spread across the interval rather than all falling due
-    at once, so adding several does not fire them together."""
+    at once, so adding several does not fire them together. A clan saved
+    by `snapshot` before a restart picks up where it was, and keeps its
+    turn if that has not come yet; the rest are spread."""
     wanted = registry.clans_with_chats(ctx.db)
     for clan_tag in list(ctx.monitors):
         if clan_tag not in wanted:
             del ctx.monitors[clan_tag]
             due.pop(clan_tag, None)
     fresh = [tag for tag in wanted if tag not in ctx.monitors]
-    for index, clan_tag in enumerate(fresh):
-        ctx.monitors[clan_tag] = build_monitor(clan_tag, wanted[clan_tag])
-        due[clan_tag] = time.monotonic() + index * POLL_INTERVAL / len(fresh)
+    states = ctx.db.monitor_states() if fresh else {}
+    now, wall = time.monotonic(), time.time()
+    spread = []
+    for clan_tag in fresh:
+        monitor = ctx.monitors[clan_tag] = build_monitor(
+            clan_tag, wanted[clan_tag])
+        state = states.get(clan_tag)
+        if state is None:
+            spread.append(clan_tag)
+            continue
+        monitor.restore(state)
+        wait = (state.get('due') or wall) - wall
+        if wait > 0:
+            due[clan_tag] = now + min(wait, BACKOFF)
+        else:
+            spread.append(clan_tag)
+    for index, clan_tag in enumerate(spread):
+        due[clan_tag] = now + index * POLL_INTERVAL / len(spread)
     for clan_tag, chats in wanted.items():
         ctx.monitors[clan_tag].chat_ids = chats
 
 
+_retained_at = None
+
+
+def retain(ctx):
+    """Prune the delivery records of long finished wars, hourly.
+
+    Every attack of every war for every chat is a row in `sent`, and
+    each one is looked up on every poll of its war. Only the wars that
+    can still be polled need theirs."""
+    global _retained_at
+    now = time.monotonic()
+    if _retained_at is not None and now - _retained_at < RETAIN_EVERY:
+        return
+    _retained_at = now
+    dropped = registry.retire_sent(ctx.db, ctx.sent_retention)
+    if dropped:
+        logger.info('Dropped %s delivery records of finished wars.', dropped)
+
+
+_snapshotted_at = None
+
+
+def snapshot(ctx, force=False):
+    """Save every monitor and when it is next due, every few minutes,
+    and the clan details fetched since the last time.
+
+    The due times are kept on the wall clock, since the monotonic one
+    starts over with the process."""
+    global _snapshotted_at
+    now = time.monotonic()
+    if (not force and _snapshotted_at is not None
+            and now - _snapshotted_at < SNAPSHOT_EVERY):
+        return
+    _snapshotted_at = now
+    wall = time.time()
+    states = {}
+    for clan_tag, monitor in ctx.monitors.items():
+        state = monitor.snapshot()
+        if clan_tag in ctx.due:
+            state['due'] = wall + ctx.due[clan_tag] - now
+        states[clan_tag] = state
+    ctx.db.save_monitor_states(
+        states, datetime.datetime.now(datetime.timezone.utc).isoformat())
+    if ctx.coc_api is not None:
+        ctx.coc_api.save_claninfo()
+
+
 def poll(ctx, monitor, notifier):
     """Fetch one clan and report it. Returns seconds until it is due again.
 
@@ -82,7 +173,18 @@ def poll(ctx, monitor, notifier):
     One private warlog used to stop the process; with several clans
     followed that would let any one of them silence the rest."""
     try:
-        leagueinfo = monitor.coc_api.get_currentleague(monitor.clan_tag)
+        leagueinfo = None
+        if wants_league(monitor):
+            leagueinfo = monitor.coc_api.get_currentleague(
+                monitor.clan_tag, previous=monitor.leagueinfo)
+            monitor.league_checked = time.time()
+            if leagueinfo and leagueinfo.is_ended():
+                if monitor.league_over == leagueinfo.season:
+                    leagueinfo = None
+                else:
+                    # Gone through once more, for the last round's
+                    # messages, and then left alone until next month.
+                    monitor.league_over = leagueinfo.season
         monitor.leagueinfo = leagueinfo
         if leagueinfo:
             # These are already fetched, so they are not asked for a
@@ -111,6 +213,31 @@ def poll(ctx, monitor, notifier):
         return BACKOFF
 
 
+def wants_league(monitor, now=None):
+    """Whether this poll asks CoC for the clan's league group.
+
+    The answer is a 404 for most of the month, and asking every poll
+    doubled the requests a clan costs. A group under way is followed
+    every poll, as is league week. Otherwise it is asked every few
+    hours, which is how a group starting late is still found, and not at
+    all once this month's group has ended."""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    if monitor.league_over == now.strftime('%Y-%m'):
+        return False
+    if monitor.leagueinfo is not None or now.day <= LEAGUE_WINDOW:
+        return True
+    return (monitor.league_checked is None
+            or now.timestamp() - monitor.league_checked >= LEAGUE_PROBE)
+
+
+def _answering(ctx):
+    """Marks CoC requests as made for a command, so they give way to
+    the polls."""
+    if ctx.coc_api is None:
+        return contextlib.nullcontext()
+    return ctx.coc_api.answering()
+
+
 def _describe(err):
     response = getattr(err, 'response', None)
     if response is None:
@@ -221,7 +348,9 @@ def answer_until(ctx, notifier, deadline):
         answered = False
         try:
             for event in notifier.receive():
-                for answer in commands.handle(ctx, event):
+                with _answering(ctx):
+                    answers = commands.handle(ctx, event)
+                for answer in answers:
                     notifier.reply(answer.chat_id, answer.text,
                                    answer.choices)
                 answered = True
@@ -4,6 +4,9 @@
 import json
 import shelve
 import sqlite3
+import zlib
+
+from . import codec, tracing
 
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS sent (
@@ -59,9 +62,107 @@ CREATE TABLE IF NOT EXISTS request (
 -- request may be pending per chat and clan; resolved ones stay as history.
 CREATE UNIQUE INDEX IF NOT EXISTS request_pending
     ON request (clan_tag, chat_id) WHERE state = 'pending';
+-- A war's rows in `sent` are only read while the war can be polled.
+-- Once it is long over they are dropped and the war is marked retired
+-- here instead, which answers for every message it ever had.
+CREATE TABLE IF NOT EXISTS finished (
+    war_id TEXT PRIMARY KEY,
+    ended_at TEXT NOT NULL,
+    retired INTEGER NOT NULL DEFAULT 0
+);
+-- A finished war whose every message reached every chat in `chats`, a
+-- sorted comma separated list. Polling it again could only repeat what
+-- `sent` already says, so it is not walked while the chats stay the same.
+CREATE TABLE IF NOT EXISTS delivered (
+    war_id TEXT NOT NULL,
+    chats TEXT NOT NULL,
+    PRIMARY KEY (war_id, chats)
+);
+-- Payloads in archive and war are compressed, see `pack`. Rows written
+-- before that are json text, and read as such until migrated.
+-- The other columns are read out of the payload as it is written, so
+-- the archive can be searched without decoding it. The clans are in the
+-- payload's slot order, like the war id, and the winner is a tag.
 CREATE TABLE IF NOT EXISTS archive (
     war_id TEXT PRIMARY KEY,
-    payload TEXT NOT NULL
+    payload TEXT NOT NULL,
+    clan_tag TEXT,
+    opponent_tag TEXT,
+    end_time TEXT,
+    winner TEXT,
+    team_size INTEGER,
+    season TEXT,
+    war_tag TEXT
+);
+-- Every archived war broken down by player, written alongside it, so a
+-- player's record is a lookup rather than a pass over the archive. A
+-- row per member per war, with the attacks it made in `attack`.
+CREATE TABLE IF NOT EXISTS player_war (
+    player_tag TEXT NOT NULL,
+    war_id TEXT NOT NULL,
+    clan_tag TEXT NOT NULL,
+    name TEXT NOT NULL,
+    townhall INTEGER,
+    map_position INTEGER,
+    attacks INTEGER NOT NULL,
+    missed INTEGER NOT NULL,
+    stars INTEGER NOT NULL,
+    destruction REAL NOT NULL,
+    three_stars INTEGER NOT NULL,
+    mirror_hits INTEGER NOT NULL,
+    season TEXT,
+    end_time TEXT,
+    PRIMARY KEY (player_tag, war_id)
+);
+CREATE INDEX IF NOT EXISTS player_war_season
+    ON player_war (clan_tag, season);
+CREATE TABLE IF NOT EXISTS attack (
+    war_id TEXT NOT NULL,
+    attack_order INTEGER NOT NULL,
+    attacker_tag TEXT NOT NULL,
+    defender_tag TEXT NOT NULL,
+    stars INTEGER NOT NULL,
+    destruction REAL NOT NULL,
+    duration INTEGER,
+    -- The defender held the attacker's own map position.
+    mirror INTEGER NOT NULL,
+    PRIMARY KEY (war_id, attack_order)
+);
+CREATE INDEX IF NOT EXISTS attack_attacker ON attack (attacker_tag, war_id);
+-- League totals, kept per season and group and added to as each war
+-- of the group ends, so the table is read rather than recounted. `seq`
+-- is the order rows were first seen, which breaks ties the way counting
+-- from scratch would. `league_folded` is what has been added.
+CREATE TABLE IF NOT EXISTS league_clan (
+    season TEXT NOT NULL,
+    group_key TEXT NOT NULL,
+    clan_tag TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    stars INTEGER NOT NULL,
+    destruction REAL NOT NULL,
+    rounds INTEGER NOT NULL,
+    PRIMARY KEY (season, group_key, clan_tag)
+);
+CREATE TABLE IF NOT EXISTS league_player (
+    season TEXT NOT NULL,
+    group_key TEXT NOT NULL,
+    player_tag TEXT NOT NULL,
+    clan_tag TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    stars INTEGER NOT NULL,
+    destruction REAL NOT NULL,
+    attacks INTEGER NOT NULL,
+    missed INTEGER NOT NULL,
+    rounds INTEGER NOT NULL,
+    PRIMARY KEY (season, group_key, player_tag)
+);
+CREATE TABLE IF NOT EXISTS league_folded (
+    season TEXT NOT NULL,
+    group_key TEXT NOT NULL,
+    war_tag TEXT NOT NULL,
+    PRIMARY KEY (season, group_key, war_tag)
 );
 CREATE TABLE IF NOT EXISTS war (
     war_tag TEXT PRIMARY KEY,
@@ -69,25 +170,191 @@ CREATE TABLE IF NOT EXISTS war (
     opponent_tag TEXT NOT NULL,
     payload TEXT
 );
+-- What each monitor knew when last saved, as json, so a restart can
+-- carry on rather than start over. See `WarMonitor.snapshot`.
+CREATE TABLE IF NOT EXISTS monitor_state (
+    clan_tag TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    saved_at TEXT NOT NULL
+);
+-- The last details fetched of each clan, packed, and when on the wall
+-- clock, so a restart can pick up the ones still fresh.
+CREATE TABLE IF NOT EXISTS claninfo (
+    clan_tag TEXT PRIMARY KEY,
+    payload BLOB NOT NULL,
+    fetched_at REAL NOT NULL
+);
 """
 
-
+# After the columns they index, which an old table only has once
+# `_add_columns` has run.
+INDEXES = """
+CREATE INDEX IF NOT EXISTS archive_clan ON archive (clan_tag);
+CREATE INDEX IF NOT EXISTS archive_opponent ON archive (opponent_tag);
+CREATE INDEX IF NOT EXISTS archive_end ON archive (end_time);
+CREATE INDEX IF NOT EXISTS archive_season ON archive (season);
+"""
+ARCHIVE_COLUMNS = ('clan_tag', 'opponent_tag', 'end_time', 'winner',
+                   'team_size', 'season')
+
+# Connection settings, by name. `safe` is sqlite's own defaults, which
+# sync the disk on every commit. `fast` syncs at checkpoints instead: an
+# outage of the machine may then lose the last few marks in `sent`,
+# which costs a repeated message, and never corrupts the file. It also
+# maps the file into memory and keeps temporary tables there, so a poll
+# reads `sent` without a system call per page. See
+# scripts/bench_sqlite.py for what each is worth.
+PROFILES = {
+    'safe': {},
+    'fast': {'synchronous': 'NORMAL',
+             'mmap_size': 256 * 1024 * 1024,
+             'cache_size': -16 * 1024,
+             'temp_store': 'MEMORY'},
+}
+PROFILE = 'fast'
+# The sqlite3 module prepares a statement once per connection and keeps
+# it, keyed on its text, for as many distinct statements as this. Every
+# statement here is a constant, so this only has to outnumber them.
+STATEMENTS = 256
+
+# What every war payload repeats, handed to zlib as a preset dictionary
+# so even the first member of a war compresses as if it were the tenth.
+# A row is only readable with the dictionary it was written with, so
+# this never changes: a better one gets a new format byte instead.
+ZDICT = (
+    b'"state":"warEnded","teamSize":15,"attacksPerMember":1,'
+    b'"battleModifier":"none","preparationStartTime":"20260801T000000.000Z",'
+    b'"startTime":"20260801T000000.000Z","endTime":"20260801T000000.000Z",'
+    b'"badgeUrls":{"small":"https://api-assets.clashofclans.com/badges/70/'
+    b'.png","large":"https://api-assets.clashofclans.com/badges/512/'
+    b'.png","medium":"https://api-assets.clashofclans.com/badges/200/.png"},'
+    b'"clanLevel":10,"attacks":15,"stars":45,"destructionPercentage":100.0,'
+    b'"opponent":{"tag":"#","name":"","clan":{"tag":"#","name":"",'
+    b'"members":[{"tag":"#","name":"","townhallLevel":16,"mapPosition":1,'
+    b'"opponentAttacks":1,"bestOpponentAttack":{"attackerTag":"#",'
+    b'"defenderTag":"#","stars":3,"destructionPercentage":100,"order":1,'
+    b'"duration":120},"attacks":[{"attackerTag":"#","defenderTag":"#",'
+    b'"stars":3,"destructionPercentage":100,"order":1,"duration":120}]},'
+    b'{"opponentAttacks":1,"bestOpponentAttack":{"destructionPercentage":100,'
+    b'"attackerTag":"#","order":1,"stars":3,"defenderTag":"#"},'
+    b'"attacks":[{"destructionPercentage":100,"attackerTag":"#","order":1,'
+    b'"stars":3,"defenderTag":"#"},{"destructionPercentage":100,'
+    b'"attackerTag":"#","order":1,"stars":3,"defenderTag":"#"}],"name":"",'
+    b'"townhallLevel":16,"tag":"#","mapPosition":1},{"tag":"#'
+)
+ZLIB = b'\x01'
+
+
+def pack(payload):
+    """A payload as stored: a format byte, then zlib over compact json.
+
+    zstd would do better, but is only in the standard library from 3.14
+    on, and a warlog that needs a third party module to read it cannot
+    be carried to an instance that lacks it."""
+    compressor = zlib.compressobj(9, zdict=ZDICT)
+    text = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+    return ZLIB + compressor.compress(text.encode('utf-8')) + \
+        compressor.flush()
+
+
+def unpack(stored):
+    """The json of a stored payload, as bytes, or as the str it already
+    is in a row from before payloads were packed."""
+    if isinstance(stored, str):
+        return stored
+    if stored[:1] != ZLIB:
+        raise ValueError(f'Unknown payload format {stored[:1]!r}.')
+    return zlib.decompressobj(zdict=ZDICT).decompress(stored[1:])
+
+
+def summarize(payload):
+    """The archive's searchable columns for one war, in ARCHIVE_COLUMNS
+    order. The season is the month the war was set up in, which is how
+    CoC names league seasons too."""
+    clan = payload.get('clan', {})
+    opponent = payload.get('opponent', {})
+    winner = None
+    for field in ('stars', 'destructionPercentage'):
+        ours, theirs = clan.get(field, 0), opponent.get(field, 0)
+        if ours != theirs:
+            winner = clan.get('tag') if ours > theirs else opponent.get('tag')
+            break
+    prepared = payload.get('preparationStartTime') or ''
+    return (clan.get('tag', ''), opponent.get('tag', ''),
+            payload.get('endTime'), winner, payload.get('teamSize'),
+            f'{prepared[:4]}-{prepared[4:6]}' if prepared else None)
+
+
+def break_down(war_id, payload, season=None, end_time=None, war_tag=None):
+    """The player_war and attack rows of one war, as two lists.
+
+    A payload that does not say how many attacks a member has means one
+    for a league war, which is what `war_tag` tells apart, as in
+    `WarInfo.attacks_per_member`. A regular war from before CoC said so
+    means two."""
+    allowed = payload.get('attacksPerMember') or (1 if war_tag else 2)
+    sides = [(side.get('tag', ''), side.get('members', ()))
+             for side in (payload.get('clan', {}), payload.get('opponent', {}))]
+    positions = {member['tag']: member.get('mapPosition')
+                 for _, members in sides for member in members}
+    players, attacks = [], []
+    for clan_tag, members in sides:
+        for member in members:
+            made = member.get('attacks', ())
+            mirrors = [positions.get(attack['defenderTag'])
+                       == member.get('mapPosition') for attack in made]
+            players.append((
+                member['tag'], war_id, clan_tag, member.get('name', ''),
+                member.get('townhallLevel'), member.get('mapPosition'),
+                len(made), max(allowed - len(made), 0),
+                sum(attack['stars'] for attack in made),
+                sum(attack['destructionPercentage'] for attack in made),
+                sum(attack['stars'] == 3 for attack in made),
+                sum(mirrors), season, end_time))
+            attacks.extend(
+                (war_id, attack['order'], attack['attackerTag'],
+                 attack['defenderTag'], attack['stars'],
+                 attack['destructionPercentage'], attack.get('duration'),
+                 mirror) for attack, mirror in zip(made, mirrors))
+    return players, attacks
+
+
+@tracing.traced_methods('sqlite')
 class Storage:
     """Remembers which messages a war has already produced."""
 
-    def __init__(self, path, bootstrap_chat_id=None):
-        self._db = sqlite3.connect(path)
+    def __init__(self, path, bootstrap_chat_id=None, profile=PROFILE):
+        self.path = path
+        self.profile = profile
+        self._db = sqlite3.connect(path, cached_statements=STATEMENTS)
+        # Only takes on a new file, and only before the journal mode is
+        # set. An older warlog reuses the pages retention frees instead
+        # of giving them back.
+        self._db.execute('PRAGMA auto_vacuum=INCREMENTAL')
         self._db.execute('PRAGMA journal_mode=WAL')
+        for pragma, value in PROFILES[profile].items():
+            self._db.execute(f'PRAGMA {pragma}={value}')
         self._migrate_sent(bootstrap_chat_id)
         self._db.executescript(SCHEMA)
         self._add_columns()
+        self._db.executescript(INDEXES)
+        self._summarize_archive()
+        self._pack_payloads()
+        self._break_down_archive()
         self._db.commit()
 
     # A column added to a table that already exists never arrives:
     # CREATE TABLE IF NOT EXISTS leaves the old table alone.
     LATER_COLUMNS = (('chat', 'lang', 'TEXT'),
                      ('chat', 'muted', 'TEXT'),
-                     ('chat', 'steward', 'TEXT'))
+                     ('chat', 'steward', 'TEXT'),
+                     ('archive', 'clan_tag', 'TEXT'),
+                     ('archive', 'opponent_tag', 'TEXT'),
+                     ('archive', 'end_time', 'TEXT'),
+                     ('archive', 'winner', 'TEXT'),
+                     ('archive', 'team_size', 'INTEGER'),
+                     ('archive', 'season', 'TEXT'),
+                     ('archive', 'war_tag', 'TEXT'))
 
     def _add_columns(self):
         for table, column, decl in self.LATER_COLUMNS:
@@ -97,6 +364,56 @@ class Storage:
                 self._db.execute(
                     f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
 
+    def _summarize_archive(self):
+        """Fill the searchable columns of wars archived before them."""
+        rows = self._db.execute(
+            'SELECT war_id, payload FROM archive WHERE clan_tag IS NULL'
+        ).fetchall()
+        self._db.executemany(
+            'UPDATE archive SET clan_tag = ?, opponent_tag = ?, '
+            'end_time = ?, winner = ?, team_size = ?, season = ? '
+            'WHERE war_id = ?',
+            (summarize(codec.loads(unpack(payload))) + (war_id,)
+             for war_id, payload in rows))
+
+    def _break_down_archive(self):
+        """Fill player_war and attack from wars archived before them,
+        once."""
+        if self.setting('players') == 'indexed':
+            return
+        for war_id, text, war_tag in self.archived_json():
+            payload = codec.loads(text)
+            self._index_players([(war_id,)], *break_down(
+                war_id, payload, summarize(payload)[5],
+                payload.get('endTime'), war_tag))
+        self.set_setting('players', 'indexed')
+
+    def _index_players(self, war_ids, players, attacks):
+        """Replace the player_war and attack rows of `war_ids`, given as
+        1-tuples, each set in one statement."""
+        self._db.executemany('DELETE FROM attack WHERE war_id = ?', war_ids)
+        self._db.executemany(
+            'INSERT OR REPLACE INTO player_war VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', players)
+        self._db.executemany(
+            'INSERT INTO attack VALUES (?, ?, ?, ?, ?, ?, ?, ?)', attacks)
+
+    def _pack_payloads(self):
+        """Compress the payloads stored as text before they were packed.
+
+        Done once, and remembered, so that opening a large archive does
+        not scan it every time. The file keeps its size until the freed
+        pages are vacuumed away."""
+        if self.setting('payloads') == 'packed':
+            return
+        self._db.create_function(
+            'pack', 1, lambda text: pack(codec.loads(text)),
+            deterministic=True)
+        for table in ('archive', 'war'):
+            self._db.execute(f'UPDATE {table} SET payload = pack(payload) '
+                             "WHERE typeof(payload) = 'text'")
+        self.set_setting('payloads', 'packed')
+
     def _migrate_sent(self, bootstrap_chat_id):
         """Give an old `sent` table its chat column.
 
@@ -127,8 +444,9 @@ class Storage:
     def is_sent(self, war_id, msg_id, chat_id):
         row = self._db.execute(
             'SELECT 1 FROM sent '
-            'WHERE war_id = ? AND msg_id = ? AND chat_id = ?',
-            (war_id, msg_id, str(chat_id))).fetchone()
+            'WHERE war_id = ? AND msg_id = ? AND chat_id = ? '
+            'UNION ALL SELECT 1 FROM finished WHERE war_id = ? AND retired',
+            (war_id, msg_id, str(chat_id), war_id)).fetchone()
         return row is not None
 
     def mark_sent(self, war_id, msg_id, chat_id):
@@ -143,6 +461,50 @@ class Storage:
             'SELECT msg_id FROM sent WHERE war_id = ? AND chat_id = ?',
             (war_id, str(chat_id)))]
 
+    def note_finished(self, war_id, ended_at):
+        """Note when a war was first seen over. Later sightings keep it."""
+        self._db.execute(
+            'INSERT OR IGNORE INTO finished (war_id, ended_at) VALUES (?, ?)',
+            (war_id, ended_at))
+        self._db.commit()
+
+    def is_delivered(self, war_id, chats):
+        return self._db.execute(
+            'SELECT 1 FROM delivered WHERE war_id = ? AND chats = ?',
+            (war_id, chats)).fetchone() is not None
+
+    def mark_delivered(self, war_id, chats):
+        self._db.execute(
+            'INSERT OR IGNORE INTO delivered (war_id, chats) VALUES (?, ?)',
+            (war_id, chats))
+        self._db.commit()
+
+    def retire_sent(self, ended_before, now):
+        """Drop `sent` for the wars over since before `ended_before`.
+
+        A war that has rows but was never seen over, because the process
+        was down at the time or it predates `finished`, counts as over
+        from `now`: no war lasts anywhere near as long as it is kept.
+        Returns the rows dropped."""
+        self._db.execute(
+            'INSERT OR IGNORE INTO finished (war_id, ended_at) '
+            'SELECT DISTINCT war_id, ? FROM sent', (now,))
+        cursor = self._db.execute(
+            'DELETE FROM sent WHERE war_id IN (SELECT war_id FROM finished '
+            'WHERE NOT retired AND ended_at < ?)', (ended_before,))
+        self._db.execute(
+            'DELETE FROM delivered WHERE war_id IN (SELECT war_id '
+            'FROM finished WHERE NOT retired AND ended_at < ?)',
+            (ended_before,))
+        self._db.execute(
+            'UPDATE finished SET retired = 1 '
+            'WHERE NOT retired AND ended_at < ?', (ended_before,))
+        self._db.commit()
+        # Through execute the pragma is stepped once, which frees a single
+        # page. executescript runs it to the end.
+        self._db.executescript('PRAGMA incremental_vacuum')
+        return cursor.rowcount
+
     def remember_war(self, war_tag, payload, keep_payload):
         """Note a league war, keeping the war itself once it has ended.
 
@@ -153,27 +515,288 @@ class Storage:
             'VALUES (?, ?, ?, ?) '
             'ON CONFLICT(war_tag) DO UPDATE SET payload = excluded.payload',
             (war_tag, payload['clan']['tag'], payload['opponent']['tag'],
-             json.dumps(payload) if keep_payload else None))
+             pack(payload) if keep_payload else None))
         self._db.commit()
 
-    def archive_war(self, war_id, payload):
-        """Keep a finished war so later seasons can be recomputed."""
-        self._db.execute(
-            'INSERT OR REPLACE INTO archive (war_id, payload) VALUES (?, ?)',
-            (war_id, json.dumps(payload, ensure_ascii=False)))
-        self._db.commit()
+    def folded_league_wars(self, season, group_key):
+        return {row[0] for row in self._db.execute(
+            'SELECT war_tag FROM league_folded '
+            'WHERE season = ? AND group_key = ?', (season, group_key))}
 
-    def archived_wars(self):
-        for war_id, payload in self._db.execute(
-                'SELECT war_id, payload FROM archive ORDER BY war_id'):
-            yield war_id, json.loads(payload)
+    def fold_league_war(self, season, group_key, war_tag, clans, players):
+        """Add one finished league war to its group's totals, once.
+
+        The rows are what the war adds, as `LeagueStandings.tally` and
+        `LeaguePlayerStats.tally` count them. It all lands in one
+        transaction, so a war is never half counted."""
+        with self._db:
+            cursor = self._db.execute(
+                'INSERT OR IGNORE INTO league_folded VALUES (?, ?, ?)',
+                (season, group_key, war_tag))
+            if not cursor.rowcount:
+                return
+            for row in clans:
+                self._db.execute(
+                    'INSERT INTO league_clan VALUES (?, ?, ?, '
+                    '(SELECT count(*) FROM league_clan '
+                    'WHERE season = ? AND group_key = ?), ?, ?, ?, ?) '
+                    'ON CONFLICT (season, group_key, clan_tag) DO UPDATE '
+                    'SET stars = stars + excluded.stars, '
+                    'destruction = destruction + excluded.destruction, '
+                    'rounds = rounds + excluded.rounds',
+                    (season, group_key, row['tag'], season, group_key,
+                     row['name'], row['stars'], row['destruction'],
+                     row['rounds']))
+            for row in players:
+                self._db.execute(
+                    'INSERT INTO league_player VALUES (?, ?, ?, ?, '
+                    '(SELECT count(*) FROM league_player '
+                    'WHERE season = ? AND group_key = ?), '
+                    '?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (season, group_key, player_tag) DO UPDATE '
+                    'SET stars = stars + excluded.stars, '
+                    'destruction = destruction + excluded.destruction, '
+                    'attacks = attacks + excluded.attacks, '
+                    'missed = missed + excluded.missed, '
+                    'rounds = rounds + excluded.rounds',
+                    (season, group_key, row['tag'], row['clan_tag'], season,
+                     group_key, row['name'], row['stars'],
+                     row['destruction'], row['attacks'], row['missed'],
+                     row['rounds']))
+
+    def player_war_rows(self, season=None, clan=None):
+        """(tag, clan_tag, name, attacks, missed, stars, destruction,
+        three_stars, mirror_hits, 1) per player per archived war, oldest
+        first, the trailing one counting the war."""
+        where, params = self._season_filter('', season, clan)
+        return self._db.execute(
+            'SELECT player_tag, clan_tag, name, attacks, missed, stars, '
+            'destruction, three_stars, mirror_hits, 1 FROM player_war '
+            f'{where} ORDER BY end_time, war_id', params).fetchall()
+
+    def matchup_rows(self, season=None, clan=None):
+        """(attacker town hall, defender town hall, stars, destruction)
+        per archived attack where both town halls are known."""
+        where, params = self._season_filter('p.', season, clan)
+        return self._db.execute(
+            'SELECT p.townhall, d.townhall, a.stars, a.destruction '
+            'FROM attack a JOIN player_war p '
+            'ON p.war_id = a.war_id AND p.player_tag = a.attacker_tag '
+            'JOIN player_war d '
+            'ON d.war_id = a.war_id AND d.player_tag = a.defender_tag '
+            f'{where} {"AND" if where else "WHERE"} '
+            'p.townhall IS NOT NULL AND d.townhall IS NOT NULL',
+            params).fetchall()
+
+    @staticmethod
+    def _season_filter(prefix, season, clan):
+        clauses, params = [], []
+        for column, value in (('season', season), ('clan_tag', clan)):
+            if value is not None:
+                clauses.append(f'{prefix}{column} = ?')
+                params.append(value)
+        return (f'WHERE {" AND ".join(clauses)}' if clauses else ''), params
+
+    def league_clans(self, season, group_key):
+        """The group's clan totals by tag, in the order first seen."""
+        columns = ('tag', 'name', 'stars', 'destruction', 'rounds')
+        return {row[0]: dict(zip(columns, row)) for row in self._db.execute(
+            'SELECT clan_tag, name, stars, destruction, rounds '
+            'FROM league_clan WHERE season = ? AND group_key = ? '
+            'ORDER BY seq', (season, group_key))}
+
+    def league_players(self, season, group_key, clan_tag):
+        """One clan's player totals in the group, by tag, in the order
+        first seen."""
+        columns = ('tag', 'name', 'stars', 'destruction', 'attacks',
+                   'missed', 'rounds')
+        return {row[0]: dict(zip(columns, row)) for row in self._db.execute(
+            'SELECT player_tag, name, stars, destruction, attacks, missed, '
+            'rounds FROM league_player '
+            'WHERE season = ? AND group_key = ? AND clan_tag = ? '
+            'ORDER BY seq', (season, group_key, clan_tag))}
+
+    def archive_war(self, war_id, payload, war_tag=None):
+        """Keep a finished war so later seasons can be recomputed.
+        `war_tag` is a league war's own tag."""
+        self.archive_wars([(war_id, payload)], {war_id: war_tag})
+
+    def archive_wars(self, wars, war_tags=None):
+        """Keep many (war_id, payload) pairs, in one transaction, and
+        their players with them. `war_tags` gives the league wars' tags
+        by war id. A war given twice is kept as given last, as it would
+        be one call at a time."""
+        war_tags = war_tags or {}
+        # Exports concatenated from two instances repeat wars, and the
+        # attack rows of a war can only go in once.
+        latest = dict(wars)
+        archived, war_ids, players, attacks = [], [], [], []
+        for war_id, payload in latest.items():
+            summary = summarize(payload)
+            war_tag = war_tags.get(war_id)
+            archived.append((war_id, pack(payload)) + summary + (war_tag,))
+            war_ids.append((war_id,))
+            war_players, war_attacks = break_down(
+                war_id, payload, summary[5], payload.get('endTime'), war_tag)
+            players += war_players
+            attacks += war_attacks
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO archive (war_id, payload, clan_tag, '
+                'opponent_tag, end_time, winner, team_size, season, war_tag) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', archived)
+            self._index_players(war_ids, players, attacks)
+
+    def player_wars(self, player_tag, clans=None, limit=10):
+        """A player's archived wars, latest first, only those played for
+        `clans` if given."""
+        columns = ('war_id', 'clan_tag', 'name', 'townhall', 'attacks',
+                   'missed', 'stars', 'destruction', 'three_stars',
+                   'mirror_hits', 'season', 'end_time')
+        where, params = self._player_filter(player_tag, clans)
+        return [dict(zip(columns, row)) for row in self._db.execute(
+            f'SELECT {", ".join(columns)} FROM player_war {where} '
+            'ORDER BY end_time DESC LIMIT ?', params + [limit])]
+
+    def player_totals(self, player_tag, clans=None):
+        """A player's whole archived record, or the part of it played for
+        `clans` if given. None if that is nothing."""
+        columns = ('wars', 'attacks', 'missed', 'stars', 'destruction',
+                   'three_stars', 'mirror_hits')
+        where, params = self._player_filter(player_tag, clans)
+        row = self._db.execute(
+            'SELECT count(*), sum(attacks), sum(missed), sum(stars), '
+            'sum(destruction), sum(three_stars), sum(mirror_hits) '
+            f'FROM player_war {where}', params).fetchone()
+        return dict(zip(columns, row)) if row[0] else None
+
+    @staticmethod
+    def _player_filter(player_tag, clans):
+        if clans is None:
+            return 'WHERE player_tag = ?', [player_tag]
+        marks = ', '.join('?' * len(clans))
+        return (f'WHERE player_tag = ? AND clan_tag IN ({marks})',
+                [player_tag] + list(clans))
+
+    def season_leaders(self, clan_tag, season, limit=10):
+        """The clan's players over a season, most stars first. The rows
+        are shaped like LeaguePlayerStats' so they print the same way."""
+        columns = ('tag', 'name', 'stars', 'destruction', 'attacks',
+                   'missed', 'rounds')
+        # With a single max() sqlite takes the bare columns from the row
+        # it picked, so the name is the one from the latest war.
+        return [dict(zip(columns, row[:-1])) for row in self._db.execute(
+            'SELECT player_tag, name, sum(stars), sum(destruction), '
+            'sum(attacks), sum(missed), count(*), max(end_time) '
+            'FROM player_war WHERE clan_tag = ? AND season = ? '
+            'GROUP BY player_tag '
+            'ORDER BY sum(stars) DESC, sum(destruction) DESC LIMIT ?',
+            (clan_tag, season, limit))]
+
+    def archived_wars(self, **filters):
+        """Every archived war, or those `filters` pick, as in
+        `find_wars`, by war id."""
+        for war_id, text, _ in self.archived_json(**filters):
+            yield war_id, codec.loads(text)
+
+    def archived_json(self, **filters):
+        """As `archived_wars`, with each war left as the json it is
+        stored as, for whoever only passes it on, and its war tag if it
+        was a league war."""
+        where, params = self._archive_filter(**filters)
+        for war_id, payload, war_tag in self._db.execute(
+                f'SELECT war_id, payload, war_tag FROM archive {where} '
+                'ORDER BY war_id', params):
+            yield war_id, unpack(payload), war_tag
+
+    def count_wars(self, **filters):
+        where, params = self._archive_filter(**filters)
+        return self._db.execute(f'SELECT count(*) FROM archive {where}',
+                                params).fetchone()[0]
+
+    def find_wars(self, **filters):
+        """The searchable columns of the wars `filters` pick, oldest
+        first, without decoding a single payload.
+
+        `clan` and `against` match a tag in either slot. `result` is
+        'win', 'lose' or 'draw' as `clan` saw it. `season` is 'YYYY-MM'.
+        `since` and `until` bound the end time, in CoC's own format."""
+        where, params = self._archive_filter(**filters)
+        columns = ('war_id',) + ARCHIVE_COLUMNS
+        return [dict(zip(columns, row)) for row in self._db.execute(
+            f'SELECT {", ".join(columns)} FROM archive {where} '
+            'ORDER BY end_time, war_id', params)]
+
+    @staticmethod
+    def _archive_filter(clan=None, against=None, result=None, season=None,
+                        team_size=None, since=None, until=None):
+        clauses, params = [], []
+        for tag in (clan, against):
+            if tag is not None:
+                # Spelled out: `? IN (clan_tag, opponent_tag)` means the
+                # same but sqlite can only answer it by scanning, where
+                # this is one lookup in each index.
+                clauses.append('(clan_tag = ? OR opponent_tag = ?)')
+                params += [tag, tag]
+        if result is not None:
+            if clan is None:
+                raise ValueError('A result is only a result for a clan.')
+            clauses.append({'win': 'winner = ?',
+                            'lose': 'winner != ?',
+                            'draw': 'winner IS NULL'}[result])
+            if result != 'draw':
+                params.append(clan)
+        for clause, value in (('season = ?', season),
+                              ('team_size = ?', team_size),
+                              ('end_time >= ?', since),
+                              ('end_time < ?', until)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = f'WHERE {" AND ".join(clauses)}' if clauses else ''
+        return where, params
 
     def finished_war(self, war_tag):
         row = self._db.execute(
             'SELECT payload FROM war WHERE war_tag = ?', (war_tag,)).fetchone()
         if row is None or row[0] is None:
             return None
-        return json.loads(row[0])
+        return codec.loads(unpack(row[0]))
+
+    def save_claninfo(self, rows, fetched_before):
+        """Write `rows`, (clan_tag, payload, fetched_at), and drop every
+        clan fetched before `fetched_before`, in one transaction."""
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO claninfo '
+                '(clan_tag, payload, fetched_at) VALUES (?, ?, ?)',
+                [(clan_tag, pack(payload), fetched_at)
+                 for clan_tag, payload, fetched_at in rows])
+            self._db.execute('DELETE FROM claninfo WHERE fetched_at < ?',
+                             (fetched_before,))
+
+    def fresh_claninfo(self, fetched_since):
+        """(clan_tag, payload, fetched_at) for every clan fetched since
+        `fetched_since`."""
+        return [(clan_tag, codec.loads(unpack(payload)), fetched_at)
+                for clan_tag, payload, fetched_at in self._db.execute(
+                    'SELECT clan_tag, payload, fetched_at FROM claninfo '
+                    'WHERE fetched_at >= ?', (fetched_since,))]
+
+    def save_monitor_states(self, states, saved_at):
+        """Replace every saved state with `states`, {clan_tag: dict}, so
+        a clan no longer followed leaves nothing behind."""
+        with self._db:
+            self._db.execute('DELETE FROM monitor_state')
+            self._db.executemany(
+                'INSERT INTO monitor_state (clan_tag, state, saved_at) '
+                'VALUES (?, ?, ?)',
+                ((clan_tag, json.dumps(state), saved_at)
+                 for clan_tag, state in states.items()))
+
+    def monitor_states(self):
+        return {clan_tag: json.loads(state) for clan_tag, state in
+                self._db.execute('SELECT clan_tag, state FROM monitor_state')}
 
     def subscriptions(self):
         return [(clan_tag, chat_id) for clan_tag, chat_id in self._db.execute(
@@ -329,6 +952,12 @@ class Storage:
         return {'id': request_id, 'clan_tag': row[0], 'chat_id': row[1],
                 'requester_id': row[2]}
 
+    def size(self):
+        """Bytes in the database file, not counting the WAL."""
+        pages, = self._db.execute('PRAGMA page_count').fetchone()
+        page_size, = self._db.execute('PRAGMA page_size').fetchone()
+        return pages * page_size
+
     def close(self):
         self._db.close()
 
@@ -0,0 +1,111 @@
+########################################################################
+# Tracing
+########################################################################
+"""Where a poll spent its time.
+
+A poll touches CoC, sqlite, the formatters and Telegram in turn, and a
+slow one says nothing about which of them it was. Spans are timed only
+while a poll is open, so a command answered between polls costs one
+attribute read per span and leaves nothing behind.
+
+Spans nest and are timed inclusively: the time given for a league's
+war tags includes the CoC calls made to fill them."""
+import collections
+import contextlib
+import functools
+import inspect
+import logging
+import time
+
+# Seconds. Every clan is due once a minute and they are polled in turn,
+# so one poll taking a good part of that holds all the others up.
+SLOW_POLL = 10
+# Enough for every clan of a busy instance to have a few polls in it.
+RECENT = 256
+
+logger = logging.getLogger(__name__)
+recent = collections.deque(maxlen=RECENT)
+_open = None
+
+
+class Trace:
+    """One poll and the spans timed inside it, totalled by name."""
+
+    def __init__(self, label):
+        self.label = label
+        self.started = time.time()
+        self.duration = 0.0
+        self.spans = {}
+
+    def add(self, name, seconds):
+        totals = self.spans.setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+    def breakdown(self):
+        """Spans, slowest first, as `name 1.23s x4`."""
+        return ', '.join(
+            f'{name} {seconds:.2f}s x{count}'
+            for name, (count, seconds) in sorted(
+                self.spans.items(), key=lambda item: -item[1][1]))
+
+
+@contextlib.contextmanager
+def poll(label):
+    """Open a trace for one poll, and keep it once it closes."""
+    global _open
+    trace, outer = Trace(label), _open
+    _open = trace
+    began = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace.duration = time.perf_counter() - began
+        _open = outer
+        recent.append(trace)
+        if trace.duration > SLOW_POLL:
+            logger.warning('Slow poll of %s took %.2fs: %s.', label,
+                           trace.duration, trace.breakdown())
+
+
+@contextlib.contextmanager
+def span(name):
+    trace = _open
+    if trace is None:
+        yield
+        return
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - began)
+
+
+def traced(name):
+    """Time every call of the decorated function as a span."""
+    def decorate(func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return timed
+    return decorate
+
+
+def traced_methods(prefix):
+    """Time every public method of a class, each under its own name.
+
+    Generators are left out: they return before doing any of their
+    work, so the span would time nothing."""
+    def decorate(cls):
+        for name, value in list(vars(cls).items()):
+            if (name.startswith('_') or not inspect.isfunction(value)
+                    or inspect.isgeneratorfunction(value)):
+                continue
+            setattr(cls, name, traced(f'{prefix}.{name}')(value))
+        return cls
+    return decorate
+
+
+def slowest(count=5):
+    return sorted(recent, key=lambda trace: -trace.duration)[:count]
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""Time decoding the war fixtures in data/ with every installed decoder.
+
+`str` is what the api used to do, decoding the bytes to a str before
+parsing them. Run from the repository root:
+
+    $ uv run --extra fast python scripts/bench_json.py
+"""
+import glob
+import json
+import os
+import timeit
+
+from clashogram import codec
+
+ROUNDS = 200
+# The best of this many runs, so a busy machine does not show as a
+# slow decoder.
+REPEAT = 7
+
+
+def main():
+    payloads = []
+    for path in sorted(glob.glob(os.path.join('data', '*.json'))):
+        with open(path, 'rb') as fixture:
+            payloads.append(fixture.read())
+    size = sum(map(len, payloads))
+    decoders = {'str': lambda raw: json.loads(raw.decode('utf-8'))}
+    decoders.update(codec.DECODERS)
+    print(f'{len(payloads)} payloads, {size / 1024:.0f} kB, '
+          f'{ROUNDS} rounds; the api uses {codec.name}')
+    baseline = None
+    for name, decode in decoders.items():
+        seconds = min(timeit.repeat(
+            lambda decode=decode: [decode(raw) for raw in payloads],
+            number=ROUNDS, repeat=REPEAT))
+        baseline = baseline or seconds
+        print(f'{name: <8} {seconds * 1000 / ROUNDS:7.3f} ms a round '
+              f'{baseline / seconds:5.2f}x')
+
+
+if __name__ == '__main__':
+    main()
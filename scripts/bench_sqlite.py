@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Time the hot warlog statements under every connection profile.
+
+A synthetic warlog is written once with as many `sent` rows as asked
+for, spread over wars of a hundred messages for three chats, and each
+profile then runs what a poll does: look messages up, mark a few sent,
+and read the chat settings. `unprepared` is the `fast` profile with the
+statement cache turned off. Run from the repository root:
+
+    $ uv run python scripts/bench_sqlite.py 2000000
+"""
+import os
+import sys
+import tempfile
+import time
+
+from clashogram import storage
+from clashogram.storage import Storage
+
+CHATS = ('c1', 'c2', 'c3')
+MESSAGES = 100
+ROUNDS = 20000
+
+
+def build(path, rows):
+    with Storage(path) as db:
+        db.remember_chat_title('c1', 'bench')
+        wars = rows // (MESSAGES * len(CHATS)) or 1
+        db._db.executemany(
+            'INSERT INTO sent (war_id, msg_id, chat_id) VALUES (?, ?, ?)',
+            ((f'#WAR{war}', f'attack{msg}', chat) for war in range(wars)
+             for msg in range(MESSAGES) for chat in CHATS))
+        db._db.commit()
+    return wars
+
+
+def poll(db, wars):
+    started = time.perf_counter()
+    for n in range(ROUNDS):
+        war_id = f'#WAR{n * 7919 % wars}'
+        chat = CHATS[n % len(CHATS)]
+        db.is_sent(war_id, f'attack{n % MESSAGES}', chat)
+        db.muted_kinds(chat)
+        db.chat_lang(chat)
+        if not n % 100:
+            db.mark_sent(war_id, f'fresh{n}', chat)
+    return time.perf_counter() - started
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'warlog.db')
+        wars = build(path, rows)
+        print(f'{rows} sent rows in {wars} wars, '
+              f'{os.path.getsize(path) / 2 ** 20:.0f} MB, {ROUNDS} rounds')
+        runs = [(name, name, storage.STATEMENTS) for name in storage.PROFILES]
+        runs.append(('unprepared', 'fast', 0))
+        for label, profile, statements in runs:
+            storage.STATEMENTS = statements
+            with Storage(path, profile=profile) as db:
+                seconds = poll(db, wars)
+            print(f'{label: <10} {seconds * 1e6 / ROUNDS:7.1f} us a round')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,40 @@
 '''Clashogram tests.'''
+import datetime
 import gettext
 import json
 import os
 import shelve
 import shutil
+import signal
 import sqlite3
 import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import MagicMock, patch
 
 import requests
-
-from clashogram import commands, registry, runner
-from clashogram.__main__ import WarMonitor
-from clashogram.api import CoCAPI
+from click.testing import CliRunner
+
+from clashogram import (
+    analytics,
+    codec,
+    commands,
+    memory,
+    metrics,
+    profiling,
+    registry,
+    runner,
+    tracing,
+)
+from clashogram.__main__ import (
+    DELIVERED_MAX,
+    WarMonitor,
+    export_wars,
+    import_wars,
+)
+from clashogram.api import CLANINFO_KEEP, CoCAPI
+from clashogram.cache import LRUCache
 from clashogram.formatters import MessageFactory
 from clashogram.i18n import gettext_
 from clashogram.models import (
@@ -26,6 +47,7 @@ from clashogram.models import (
     unused_attacks,
 )
 from clashogram.notifiers import Membership, TelegramNotifier
+from clashogram.ratelimit import KeyPool, TokenBucket
 from clashogram.storage import Storage, import_shelve
 
 
@@ -141,6 +163,25 @@ class WarInfoTestCase(unittest.TestCase):
         self.assertEqual(self.warinfo.create_war_id(),
                          "#YVL0C8UY#JC0L922Y20170602T201148.000Z")
 
+    def test_members_read_like_the_payload(self):
+        player = self.warinfo.get_player_info(self.op_member['tag'])
+        self.assertEqual(dict(**player), {
+            key: value for key, value in self.op_member.items()
+            if key != 'bestOpponentAttack'} | {
+            'bestOpponentAttack': player['bestOpponentAttack']})
+        self.assertNotIn('attacks', player)
+        # Shared with the attack it names rather than held twice.
+        self.assertIs(player['bestOpponentAttack'],
+                      self.warinfo.ordered_attacks[78][1])
+
+    def test_the_payload_is_let_go_once_read(self):
+        payload = load_wardata('inWar_40.json')
+        self.assertIsNone(self.warinfo.data)
+        self.warinfo.get_player_info(self.op_member['tag'])
+        self.assertLess(memory.deep_size(self.warinfo),
+                        memory.deep_size(payload) / 2)
+        self.assertIs(WarInfo(payload, keep_data=True).data, payload)
+
 
 class WarInfoNotInWarTestCase(unittest.TestCase):
     def setUp(self):
@@ -269,6 +310,50 @@ class StorageTestCase(unittest.TestCase):
             self.assertTrue(db.is_sent('war1', 'war_msg', 'c1'))
             self.assertTrue(db.is_sent('war2', 'preparation_msg', 'c1'))
 
+    def test_long_finished_wars_are_retired_not_resent(self):
+        with Storage(self.path) as db:
+            for war_id in ('old', 'recent', 'live'):
+                db.mark_sent(war_id, 'war_msg', 'c1')
+            db.note_finished('old', '2026-01-01T00:00:00+00:00')
+            db.note_finished('recent', '2026-01-20T00:00:00+00:00')
+            dropped = db.retire_sent('2026-01-15T00:00:00+00:00',
+                                     '2026-01-21T00:00:00+00:00')
+            self.assertEqual(dropped, 1)
+            self.assertEqual(db._db.execute(
+                'SELECT war_id FROM sent ORDER BY war_id').fetchall(),
+                [('live',), ('recent',)])
+            # Every message of a retired war reads as sent, even new ones.
+            self.assertTrue(db.is_sent('old', 'war_over_msg', 'c2'))
+            self.assertFalse(db.is_sent('recent', 'war_over_msg', 'c1'))
+            # Never seen over, so counted from the pass that found it.
+            self.assertEqual(db.retire_sent('2026-01-22T00:00:00+00:00',
+                                            '2026-01-23T00:00:00+00:00'), 2)
+            self.assertTrue(db.is_sent('live', 'war_over_msg', 'c1'))
+
+    def test_the_profile_decides_how_often_the_disk_is_synced(self):
+        pragma = 'PRAGMA synchronous'
+        with Storage(self.path, profile='safe') as db:
+            self.assertEqual(db._db.execute(pragma).fetchone(), (2,))
+        with Storage(self.path, profile='fast') as db:
+            self.assertEqual(db._db.execute(pragma).fetchone(), (1,))
+
+    def test_new_warlogs_give_freed_pages_back(self):
+        with Storage(self.path) as db:
+            mode, = db._db.execute('PRAGMA auto_vacuum').fetchone()
+            self.assertEqual(mode, 2)
+            db._db.executemany(
+                'INSERT INTO sent (war_id, msg_id, chat_id) VALUES (?, ?, ?)',
+                (('old', f'attack{n}', 'c1') for n in range(20000)))
+            db.note_finished('old', '2026-01-01T00:00:00+00:00')
+            db._db.commit()
+            pages, = db._db.execute('PRAGMA page_count').fetchone()
+            db.retire_sent('2026-01-15T00:00:00+00:00',
+                           '2026-01-21T00:00:00+00:00')
+            self.assertEqual(
+                db._db.execute('PRAGMA freelist_count').fetchone(), (0,))
+            self.assertLess(
+                db._db.execute('PRAGMA page_count').fetchone()[0], pages / 2)
+
 
 class LeagueWarCacheTestCase(unittest.TestCase):
     """Most of a league group is other clans' wars, fetched once."""
@@ -281,14 +366,17 @@ class LeagueWarCacheTestCase(unittest.TestCase):
 
     def _api(self):
         api = CoCAPI('token', cache=self.db)
-        api._call_api = self._payload
+        api._fetch = lambda endpoint: json.dumps(
+            self._payload(endpoint)).encode()
         return api
 
     def _payload(self, endpoint):
         war_tag = '#' + endpoint.rsplit('%23', 1)[-1]
         self.fetched.append(war_tag)
+        # Every body differs, as a war being fought moves between polls.
         return {'state': 'inWar' if war_tag.endswith('LIVE') else 'warEnded',
                 'teamSize': 15, 'preparationStartTime': 'T',
+                'fetch': len(self.fetched),
                 'clan': {'tag': '#US' if war_tag.startswith('#OURS')
                                 else '#OTHER' + war_tag,
                          'name': 'a', 'members': []},
@@ -314,6 +402,295 @@ class LeagueWarCacheTestCase(unittest.TestCase):
         self._populate()
         self.assertEqual(self.fetched, ['#OURSLIVE'])
 
+    def test_finished_wars_are_kept_decoded(self):
+        api = self._api()
+        first = LeagueInfo('#US', {'rounds': self.rounds})
+        first.populate_wartags(api)
+        self.db.finished_war = MagicMock(side_effect=self.db.finished_war)
+        second = LeagueInfo('#US', {'rounds': self.rounds})
+        second.populate_wartags(api)
+        # Only the war still being fought goes past memory.
+        self.db.finished_war.assert_called_once_with('#OURSLIVE')
+        self.assertIs(second.wartags['#OURSDONE'], first.wartags['#OURSDONE'])
+        self.assertIsNot(second.wartags['#OURSLIVE'],
+                         first.wartags['#OURSLIVE'])
+
+    def test_the_group_held_hands_its_finished_wars_back(self):
+        # However many clans are in league: nothing is looked up at all.
+        api = CoCAPI('token', cache=self.db, league_wars_max=1)
+        api._fetch = lambda endpoint: json.dumps(
+            self._payload(endpoint)).encode()
+        first = LeagueInfo('#US', {'rounds': self.rounds})
+        first.populate_wartags(api)
+        self.db.finished_war = MagicMock(side_effect=self.db.finished_war)
+        second = LeagueInfo('#US', {'rounds': self.rounds})
+        second.populate_wartags(api, first)
+        self.db.finished_war.assert_called_once_with('#OURSLIVE')
+        for war_tag in ('#OURSDONE', '#THEIRSA', '#THEIRSB'):
+            self.assertIs(second.wartags[war_tag], first.wartags[war_tag])
+
+
+class FingerprintTestCase(unittest.TestCase):
+    """A body that has not changed is neither decoded nor gone
+    through again."""
+
+    def setUp(self):
+        self.body = json.dumps(load_wardata('inWar_40.json')).encode()
+        self.api = CoCAPI('token')
+        self.api._fetch = MagicMock(side_effect=lambda endpoint: self.body)
+
+    def test_unchanged_body_gives_back_the_same_war(self):
+        first = self.api.get_currentwar('#US')
+        self.assertIs(self.api.get_currentwar('#US', previous=first), first)
+        self.body = self.body.replace(b'"inWar"', b'"warEnded"')
+        self.assertIsNot(self.api.get_currentwar('#US', previous=first),
+                         first)
+
+    def test_a_league_war_that_has_not_moved_is_handed_back(self):
+        rounds = {'rounds': [{'warTags': ['#W1']}]}
+        first = LeagueInfo('#US', rounds)
+        first.populate_wartags(self.api)
+        second = LeagueInfo('#US', rounds)
+        second.populate_wartags(self.api, first)
+        self.assertIs(second.wartags['#W1'], first.wartags['#W1'])
+
+    def test_any_number_of_clans_polled_in_turn_are_recognised(self):
+        tags = [f'#CLAN{n}' for n in range(200)]
+        last = {tag: self.api.get_currentwar(tag) for tag in tags}
+        for tag in tags:
+            self.assertIs(self.api.get_currentwar(tag, previous=last[tag]),
+                          last[tag])
+
+    def test_monitor_skips_a_war_it_has_been_through(self):
+        notifier = MagicMock()
+        monitor = WarMonitor(Storage(':memory:'), self.api, '#US', notifier,
+                             ['c1'])
+        self.api.get_claninfo = MagicMock()
+        monitor.update()
+        skipped = metrics.counters['unchanged']
+        with patch.object(monitor.db, 'is_sent') as is_sent:
+            monitor.update()
+        is_sent.assert_not_called()
+        self.assertEqual(metrics.counters['unchanged'], skipped + 1)
+        self.assertIsNotNone(monitor.warinfo)
+        # A chat joining brings the war back.
+        monitor.chat_ids.append('c2')
+        notifier.send.reset_mock()
+        monitor.update()
+        self.assertTrue(notifier.send.called)
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.slept = []
+        self.bucket = TokenBucket(2, 4, clock=lambda: self.now,
+                                  sleep=self._sleep)
+
+    def _sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def test_burst_goes_out_at_once_then_the_rate_holds(self):
+        for _ in range(4):
+            self.assertEqual(self.bucket.take(), 0)
+        self.assertEqual(self.bucket.take(), 0.5)
+        self.assertEqual(self.slept, [0.5])
+
+    def test_a_command_leaves_the_reserve_to_the_polls(self):
+        for _ in range(2):
+            self.bucket.take()
+        # Two tokens left: a poll takes one at once, a command keeping
+        # two back waits for a third.
+        self.assertEqual(self.bucket.take(reserve=2), 0.5)
+        self.assertEqual(self.bucket.take(), 0)
+
+    def test_every_call_passes_through_the_limiter(self):
+        api = CoCAPI('token', burst=10)
+        response = MagicMock(status_code=200, content=b'{"items": []}')
+        with patch('clashogram.api.requests.get', return_value=response), \
+             patch.object(api.limiter, 'take') as take:
+            api.get_warleagues()
+            with api.answering():
+                api.get_leaguetiers()
+        self.assertEqual([call.args for call in take.call_args_list],
+                         [(0,), (5,)])
+
+
+class KeyPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.api = CoCAPI('one, two', burst=4)
+        self.used = []
+
+    def _response(self, status, body=b'{}'):
+        res = requests.Response()
+        res.status_code = status
+        res._content = body
+        res.headers['Retry-After'] = '30'
+        return res
+
+    def _get(self, *answers, body=b'{}'):
+        answers = iter(answers)
+
+        def get(endpoint, headers):
+            self.used.append(headers['Authorization'].split()[-1])
+            return self._response(next(answers), body)
+        return get
+
+    def test_requests_spread_by_what_each_key_has_left(self):
+        with patch('clashogram.api.requests.get', self._get(*[200] * 4)):
+            for _ in range(4):
+                self.api._fetch('url')
+        self.assertEqual(sorted(self.used), ['one', 'one', 'two', 'two'])
+
+    def test_a_refused_key_is_left_out_and_the_request_goes_again(self):
+        refused = self._get(403, 200,
+                            body=b'{"reason": "accessDenied.invalidIp"}')
+        with patch('clashogram.api.requests.get', refused):
+            self.api._fetch('url')
+        self.assertEqual(len(set(self.used)), 2)
+        self.assertEqual(len(self.api.limiter.usable()), 1)
+        self.used.clear()
+        # A private warlog is about the clan, not the key.
+        api = CoCAPI('one,two')
+        private = self._get(403, body=b'{"reason": "accessDenied",'
+                                      b' "message": "war log is private"}')
+        with patch('clashogram.api.requests.get', private), \
+             self.assertRaises(requests.HTTPError):
+            api._fetch('url')
+        self.assertEqual(len(self.used), 1)
+        self.assertEqual(len(api.limiter.usable()), 2)
+
+    def test_a_403_without_a_message_is_not_about_the_key(self):
+        for body in (b'{"reason": "accessDenied", "message": null}',
+                     b'["denied"]', b'"denied"'):
+            api = CoCAPI('one,two')
+            with patch('clashogram.api.requests.get',
+                       self._get(403, body=body)), \
+                 self.assertRaises(requests.HTTPError):
+                api._fetch('url')
+            self.assertEqual(len(api.limiter.usable()), 2)
+
+    def test_a_throttled_key_rests_while_the_other_works(self):
+        with patch('clashogram.api.requests.get', self._get(429, 200)), \
+             patch('clashogram.api.time.sleep') as sleep:
+            self.api._fetch('url')
+        sleep.assert_not_called()
+        self.assertEqual(len(set(self.used)), 2)
+        self.assertEqual([key.token for key in self.api.limiter.usable()],
+                         [self.used[-1]])
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def test_callers_at_once_share_one_request(self):
+        api = CoCAPI('token')
+        release = threading.Event()
+        calls = []
+
+        def get(endpoint, headers):
+            calls.append(endpoint)
+            release.wait(5)
+            res = requests.Response()
+            res.status_code = 200
+            res._content = b'{"name": "a"}'
+            return res
+
+        bodies = []
+        coalesced = metrics.counters['coc.coalesced']
+        with patch('clashogram.api.requests.get', get):
+            threads = [threading.Thread(
+                target=lambda: bodies.append(api._fetch('url')))
+                for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            deadline = time.monotonic() + 5
+            while (metrics.counters['coc.coalesced'] - coalesced < 4
+                   and time.monotonic() < deadline):
+                time.sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+        self.assertEqual(calls, ['url'])
+        self.assertEqual(bodies, [b'{"name": "a"}'] * 5)
+        self.assertEqual(api._flights, {})
+
+    def test_the_error_reaches_every_waiter_and_is_not_kept(self):
+        api = CoCAPI('token')
+        api._request = MagicMock(side_effect=requests.ConnectionError)
+        with self.assertRaises(requests.ConnectionError):
+            api._fetch('url')
+        api._request = MagicMock(return_value=b'{}')
+        self.assertEqual(api._fetch('url'), b'{}')
+
+
+class WarmRestartTestCase(unittest.TestCase):
+    """A restart picks up the schedule and the wars gone through."""
+
+    def setUp(self):
+        self.db = Storage(':memory:')
+        registry.subscribe(self.db, '#US', 'c1')
+        registry.subscribe(self.db, '#OTHER', 'c1')
+        self.body = json.dumps(load_wardata('inWar_40.json')).encode()
+
+    def _build(self, clan_tag, chat_ids):
+        api = CoCAPI('token')
+        api._fetch = MagicMock(return_value=self.body)
+        api.get_claninfo = MagicMock()
+        return WarMonitor(self.db, api, clan_tag, MagicMock(), chat_ids)
+
+    def _start(self):
+        ctx = commands.Context(db=self.db, monitors={})
+        runner.sync(ctx, self._build, ctx.due)
+        return ctx
+
+    def test_monitors_carry_on_after_a_restart(self):
+        ctx = self._start()
+        ours = ctx.monitors['#US']
+        ours.update()
+        ours.league_over = '2026-10'
+        ctx.due['#US'] = time.monotonic() + 30
+        ctx.due['#OTHER'] = time.monotonic() - 5
+        runner.snapshot(ctx, force=True)
+
+        ctx = self._start()
+        ours = ctx.monitors['#US']
+        self.assertEqual(ours.league_over, '2026-10')
+        self.assertAlmostEqual(ctx.due['#US'] - time.monotonic(), 30, delta=1)
+        # Overdue, so spread with the others rather than fired at once.
+        self.assertLessEqual(ctx.due['#OTHER'], time.monotonic())
+        with patch.object(self.db, 'is_sent') as is_sent:
+            ours.update()
+        is_sent.assert_not_called()
+        self.assertIsNotNone(ours.warinfo)
+
+    def test_a_war_that_moved_is_walked(self):
+        ctx = self._start()
+        ctx.monitors['#US'].update()
+        runner.snapshot(ctx, force=True)
+        self.body = self.body.replace(b'"inWar"', b'"preparation"')
+        ours = self._start().monitors['#US']
+        with patch.object(self.db, 'is_sent',
+                          side_effect=self.db.is_sent) as is_sent:
+            ours.update()
+        self.assertTrue(is_sent.called)
+
+    def test_a_group_under_way_is_asked_for_first_thing(self):
+        ctx = self._start()
+        ours = ctx.monitors['#US']
+        ours.leagueinfo = LeagueInfo('#US', {'rounds': []})
+        ours.league_checked = time.time()
+        runner.snapshot(ctx, force=True)
+        self.assertIsNone(self._start().monitors['#US'].league_checked)
+
+    def test_leaving_puts_the_sigterm_handler_back(self):
+        ctx = commands.Context(db=self.db, monitors={})
+        before = signal.getsignal(signal.SIGTERM)
+        with patch.object(runner, 'publish_menu'), \
+             patch.object(runner, 'sync', side_effect=KeyboardInterrupt), \
+             self.assertRaises(KeyboardInterrupt):
+            runner.run(ctx, self._build, MagicMock())
+        self.assertIs(signal.getsignal(signal.SIGTERM), before)
+
 
 class LeagueStandingsTestCase(unittest.TestCase):
     def _war(self, a, a_stars, b, b_stars, state='warEnded'):
@@ -338,7 +715,7 @@ class LeagueStandingsTestCase(unittest.TestCase):
     def test_a_draw_hands_out_no_bonus(self):
         # Equal stars and unequal destruction is a win, so force both equal.
         war = self._war('A', 30, 'B', 30)
-        war.data['opponent']['destructionPercentage'] = 90
+        war.opponent.destructionPercentage = 90
         rows = self._standings([war])
         self.assertEqual([r['stars'] for r in rows], [30, 30])
 
@@ -346,6 +723,31 @@ class LeagueStandingsTestCase(unittest.TestCase):
         self.assertEqual(
             self._standings([self._war('A', 30, 'B', 25, state='inWar')]), [])
 
+    def test_counting_a_war_never_indexes_it(self):
+        war = self._war('A', 30, 'B', 25)
+        self._standings([war])
+        self.assertNotIn('_indexes', vars(war))
+
+    def test_a_war_lets_its_payload_go(self):
+        payload = load_wardata('warEnded_50.json')
+        war = WarInfo(payload)
+        self.assertLess(memory.deep_size(war), memory.deep_size(payload) / 2)
+
+    def test_a_warlog_keeps_the_table_and_counts_each_war_once(self):
+        wars = [self._war('A', 30, 'B', 25), self._war('C', 20, 'A', 20),
+                self._war('B', 10, 'C', 12), self._war('A', 5, 'B', 3,
+                                                       state='inWar')]
+        leagueinfo = LeagueInfo('#A', {'season': '2026-10', 'rounds': []})
+        leagueinfo.wartags.update(dict(enumerate(wars)))
+        db = Storage(':memory:')
+        counted = LeagueStandings(leagueinfo, db).rows()
+        self.assertEqual(counted, self._standings(wars))
+        self.assertEqual(LeagueStandings(leagueinfo, db).rows(), counted)
+        # After a restart the group is fetched afresh, with the same wars
+        # finished, and nothing is counted twice.
+        leagueinfo.wartags.clear()
+        self.assertEqual(LeagueStandings(leagueinfo, db).rows(), counted)
+
 
 class LeaguePlayerStatsTestCase(unittest.TestCase):
     def setUp(self):
@@ -359,8 +761,12 @@ class LeaguePlayerStatsTestCase(unittest.TestCase):
         self.warinfo = WarInfo({'state': 'warEnded', 'teamSize': 2,
                                 'preparationStartTime': 'T',
                                 'clan': {'tag': '#US', 'name': 'us',
+                                         'stars': 3,
+                                         'destructionPercentage': 50,
                                          'members': [member, idle]},
                                 'opponent': {'tag': '#THEM', 'name': 'them',
+                                             'stars': 0,
+                                             'destructionPercentage': 0,
                                              'members': []}},
                                '#US', '#WAR1')
         self.leagueinfo = LeagueInfo('#US', {'rounds': []})
@@ -374,6 +780,14 @@ class LeaguePlayerStatsTestCase(unittest.TestCase):
         self.assertEqual((rows['two']['attacks'], rows['two']['missed']),
                          (0, 1))
 
+    def test_a_warlog_gives_the_same_rows(self):
+        expected = LeaguePlayerStats(self.leagueinfo).rows()
+        db = Storage(':memory:')
+        self.assertEqual(LeaguePlayerStats(self.leagueinfo, db).rows(),
+                         expected)
+        self.assertEqual(LeaguePlayerStats(self.leagueinfo, db).rows(),
+                         expected)
+
     def test_unused_attacks_lists_only_the_idle(self):
         self.assertEqual([m['name'] for m in unused_attacks(self.warinfo)],
                          ['two'])
@@ -619,6 +1033,37 @@ class WarMonitorOnWarOverTestCase(WarMonitorTestCase):
         self.monitor.warinfo = self.warinfo
         self.assertTrue(self.monitor.is_msg_sent('war_over_msg', 'c1'))
 
+    def test_delivered_war_is_not_walked_again(self):
+        with patch.object(self.monitor.db, 'is_sent') as is_sent:
+            self.monitor.update()
+        is_sent.assert_not_called()
+        # A restarted monitor finds the marker in the warlog.
+        again = WarMonitor(self.monitor.db, self.monitor.coc_api, '',
+                           self.monitor.notifier, ['c1'])
+        with patch.object(again.db, 'is_sent') as is_sent:
+            again.update()
+        is_sent.assert_not_called()
+
+    def test_new_chat_brings_a_delivered_war_back(self):
+        self.monitor.chat_ids.append('c2')
+        self.monitor.notifier.send.reset_mock()
+        self.monitor.update()
+        self.assertTrue(self.monitor.notifier.send.called)
+        self.assertEqual({call.args[1] for call in
+                          self.monitor.notifier.send.call_args_list}, {'c2'})
+
+    def test_delivered_wars_are_remembered_up_to_a_bound(self):
+        monitor = WarMonitor(Storage(':memory:'), MagicMock(), '#US',
+                             MagicMock(), ['c1'])
+        wars = [MagicMock(**{'create_war_id.return_value': f'W{n}'})
+                for n in range(DELIVERED_MAX * 2)]
+        for warinfo in wars:
+            monitor.db.mark_delivered(warinfo.create_war_id(), 'c1')
+            self.assertTrue(monitor.is_delivered(warinfo))
+        self.assertEqual(len(monitor.delivered), DELIVERED_MAX)
+        # The ones let go are still found in the db.
+        self.assertTrue(monitor.is_delivered(wars[0]))
+
 
 
 class TwoClansInOneWarTestCase(unittest.TestCase):
@@ -783,7 +1228,8 @@ class ArchiveTestCase(unittest.TestCase):
         db = Storage(':memory:')
         coc_api = CoCAPI(None)
         coc_api.get_currentwar = MagicMock(
-            return_value=WarInfo(load_wardata('warEnded_50.json')))
+            return_value=WarInfo(load_wardata('warEnded_50.json'),
+                                 keep_data=archive))
         coc_api.get_claninfo = MagicMock(return_value=ClanInfo(
             {'location': {'name': 'Iran', 'isCountry': 'true',
                           'countryCode': 'IR'}, 'warWinStreak': 0}))
@@ -797,6 +1243,136 @@ class ArchiveTestCase(unittest.TestCase):
         self.assertEqual(len(self._run_a_finished_war(True)), 1)
 
 
+class PackedPayloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'warlog.db')
+        self.wardata = load_wardata('warEnded_50.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_payloads_come_back_as_they_went_in_and_smaller(self):
+        with Storage(self.path) as db:
+            db.archive_war('W1', self.wardata)
+            self.assertEqual(list(db.archived_wars()),
+                             [('W1', self.wardata)])
+            stored, = db._db.execute(
+                'SELECT length(payload) FROM archive').fetchone()
+        self.assertLess(stored, len(json.dumps(self.wardata)) / 5)
+
+    def test_text_rows_are_read_and_then_packed(self):
+        db = sqlite3.connect(self.path)
+        db.execute('CREATE TABLE archive (war_id TEXT PRIMARY KEY, '
+                   'payload TEXT NOT NULL)')
+        db.execute('INSERT INTO archive VALUES (?, ?)',
+                   ('W1', json.dumps(self.wardata)))
+        db.commit()
+        db.close()
+        with Storage(self.path) as db:
+            kind, = db._db.execute(
+                'SELECT typeof(payload) FROM archive').fetchone()
+            self.assertEqual(kind, 'blob')
+            self.assertEqual(list(db.archived_wars()),
+                             [('W1', self.wardata)])
+
+
+class ArchiveQueryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = Storage(':memory:')
+        for war_id, us, them, stars, end in (
+                ('W1', '#US', '#A', (30, 20), '20260105T000000.000Z'),
+                ('W2', '#B', '#US', (30, 20), '20260110T000000.000Z'),
+                ('W3', '#US', '#B', (25, 25), '20260202T000000.000Z')):
+            self.db.archive_war(war_id, {
+                'state': 'warEnded', 'teamSize': 15, 'endTime': end,
+                'preparationStartTime': end,
+                'clan': {'tag': us, 'stars': stars[0],
+                         'destructionPercentage': 90.0},
+                'opponent': {'tag': them, 'stars': stars[1],
+                             'destructionPercentage': 90.0}})
+
+    def tearDown(self):
+        self.db.close()
+
+    def _ids(self, **filters):
+        return [war['war_id'] for war in self.db.find_wars(**filters)]
+
+    def test_a_clan_is_looked_up_not_scanned_for(self):
+        for filters in ({'clan': '#US'}, {'clan': '#US', 'against': '#B'},
+                        {'against': '#B', 'season': '2026-01'}):
+            where, params = self.db._archive_filter(**filters)
+            plan = ' '.join(row[-1] for row in self.db._db.execute(
+                f'EXPLAIN QUERY PLAN SELECT war_id FROM archive {where}',
+                params))
+            self.assertNotIn('SCAN archive', plan)
+
+    def test_wars_are_found_by_their_columns(self):
+        self.assertEqual(self._ids(clan='#US'), ['W1', 'W2', 'W3'])
+        self.assertEqual(self._ids(clan='#US', against='#B'), ['W2', 'W3'])
+        self.assertEqual(self._ids(clan='#US', result='win'), ['W1'])
+        self.assertEqual(self._ids(clan='#US', result='lose'), ['W2'])
+        self.assertEqual(self._ids(clan='#US', result='draw'), ['W3'])
+        self.assertEqual(self._ids(season='2026-02'), ['W3'])
+        self.assertEqual(self._ids(since='20260106T000000.000Z',
+                                   until='20260201T000000.000Z'), ['W2'])
+        self.assertEqual([war_id for war_id, _ in
+                          self.db.archived_wars(against='#A')], ['W1'])
+
+    def test_wars_archived_before_the_columns_are_filled_in(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'warlog.db')
+        db = sqlite3.connect(path)
+        db.execute('CREATE TABLE archive (war_id TEXT PRIMARY KEY, '
+                   'payload TEXT NOT NULL)')
+        db.execute('INSERT INTO archive VALUES (?, ?)', (
+            'W1', json.dumps(load_wardata('warEnded_50.json'))))
+        db.commit()
+        db.close()
+        with Storage(path) as db:
+            war, = db.find_wars()
+        self.assertEqual(war['team_size'], 50)
+        self.assertIn(war['winner'], (war['clan_tag'], war['opponent_tag']))
+
+
+class ArchiveTransferTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_an_archive_survives_export_and_import(self):
+        wars = [(f'W{n}', dict(load_wardata('warEnded_50.json'),
+                               teamSize=n)) for n in range(5)]
+        with Storage(self._path('from.db')) as db:
+            db.archive_wars(wars, {'W0': '#LEAGUEWAR'})
+        runner = CliRunner()
+        exported = runner.invoke(export_wars, [
+            self._path('from.db'), self._path('wars.jsonl')])
+        self.assertIn('Exported 5 wars.', exported.output)
+        with patch('clashogram.__main__.IMPORT_BATCH', 2):
+            imported = runner.invoke(import_wars, [
+                self._path('wars.jsonl'), self._path('to.db')])
+        self.assertIn('Imported 5 wars.', imported.output)
+        with Storage(self._path('to.db')) as db:
+            self.assertEqual(list(db.archived_wars()), wars)
+            self.assertEqual([war_tag for _, _, war_tag in db.archived_json()],
+                             ['#LEAGUEWAR'] + [None] * 4)
+
+    def test_export_takes_the_archive_filters(self):
+        with Storage(self._path('from.db')) as db:
+            db.archive_wars([('W1', load_wardata('warEnded_50.json'))])
+        result = CliRunner().invoke(export_wars, [
+            self._path('from.db'), self._path('wars.jsonl'),
+            '--season', '1999-01'])
+        self.assertIn('Exported 0 wars.', result.output)
+
+
 class SentMigrationTestCase(unittest.TestCase):
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp()
@@ -846,6 +1422,45 @@ class CoOperatorTestCase(unittest.TestCase):
         self.assertEqual(self.db.operators(), ['77'])
 
 
+class LeagueProbeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = Storage(':memory:')
+        self.coc_api = MagicMock()
+        self.monitor = WarMonitor(self.db, self.coc_api, '#US', MagicMock(),
+                                  ['c1'])
+        self.monitor.update = MagicMock()
+
+    def _wants(self, day, hour=0):
+        return runner.wants_league(self.monitor, datetime.datetime(
+            2026, 10, day, hour, tzinfo=datetime.timezone.utc))
+
+    def test_the_group_is_asked_for_rarely_outside_league_week(self):
+        self.assertTrue(self._wants(3))
+        self.monitor.league_checked = datetime.datetime(
+            2026, 10, 20, tzinfo=datetime.timezone.utc).timestamp()
+        self.assertFalse(self._wants(20, 5))
+        self.assertTrue(self._wants(20, 6))
+        # A group under way is followed whatever the day.
+        self.monitor.leagueinfo = LeagueInfo('#US', {'state': 'inWar'})
+        self.assertTrue(self._wants(20, 1))
+
+    def test_an_ended_group_is_gone_through_once_then_dropped(self):
+        ended = LeagueInfo('#US', {'state': 'ended', 'season': '2026-10',
+                                   'rounds': []})
+        self.coc_api.get_currentleague.return_value = ended
+        ctx = commands.Context(db=self.db, monitors={})
+        with patch('clashogram.runner.wants_league', return_value=True):
+            runner.poll(ctx, self.monitor, MagicMock())
+            self.assertIs(self.monitor.leagueinfo, ended)
+            self.monitor.update.assert_not_called()
+            runner.poll(ctx, self.monitor, MagicMock())
+        self.assertIsNone(self.monitor.leagueinfo)
+        self.monitor.update.assert_called_once_with()
+        self.assertFalse(runner.wants_league(
+            self.monitor, datetime.datetime(2026, 10, 3,
+                                            tzinfo=datetime.timezone.utc)))
+
+
 class NetworkBlipTestCase(unittest.TestCase):
     def test_a_dns_blip_does_not_kill_the_poll(self):
         # What crash-looped the deployed bot 28 times: ConnectionError is
@@ -1004,5 +1619,315 @@ class EscapingTestCase(unittest.TestCase):
         self.assertNotIn('<b>', said)
 
 
+class TracingTestCase(unittest.TestCase):
+    def setUp(self):
+        tracing.recent.clear()
+
+    def test_a_slow_poll_is_logged_with_what_it_spent_time_on(self):
+        db = Storage(':memory:')
+        with patch('clashogram.tracing.SLOW_POLL', 0), \
+             self.assertLogs('clashogram.tracing', 'WARNING') as logged, \
+             tracing.poll('#US'):
+            db.is_sent('W1', 'm1', 'c1')
+        self.assertIn('sqlite.is_sent', logged.output[0])
+
+    def test_spans_outside_a_poll_are_not_kept(self):
+        with tracing.span('coc'):
+            pass
+        self.assertEqual(list(tracing.recent), [])
+
+    def test_the_operator_is_shown_the_slowest_polls(self):
+        for label in ('#FAST', '#SLOW'):
+            with tracing.poll(label) as trace:
+                pass
+            trace.duration = 9 if label == '#SLOW' else 1
+        ctx = commands.Context(db=Storage(':memory:'), monitors={},
+                               admin_id='42')
+        said = commands.answer(ctx, 'c1', '42', '/slow')[0].text
+        self.assertLess(said.index('#SLOW'), said.index('#FAST'))
+
+
+class StatusTestCase(unittest.TestCase):
+    def test_the_figures_come_from_memory(self):
+        db = Storage(':memory:')
+        registry.subscribe(db, '#US', 'c1')
+        registry.subscribe(db, '#US', 'c2')
+        monitor = MagicMock()
+        monitor.unsent = {('W1', 'war_msg', 'c1')}
+        coc_api = MagicMock()
+        coc_api.limiter = KeyPool(['key'], 10, 10)
+        ctx = commands.Context(db=db, monitors={'#US': monitor},
+                               admin_id='42', coc_api=coc_api,
+                               due={'#US': 0})
+        said = commands.answer(ctx, 'c1', '42', '/status')[0].text
+        self.assertIn('Clans 1, chats 2', said)
+        self.assertIn('Telegram 1 messages waiting', said)
+        self.assertIn('Next clan due in 0s', said)
+        self.assertEqual(coc_api.mock_calls, [])
+
+
+class PlayerIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = Storage(':memory:')
+        self.wardata = load_wardata('warEnded_50.json')
+        self.db.archive_war('W1', self.wardata)
+        self.clan_tag = self.wardata['clan']['tag']
+        self.member = max(self.wardata['clan']['members'],
+                          key=lambda member: len(member.get('attacks', ())))
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_a_player_record_matches_the_payload(self):
+        made = self.member['attacks']
+        totals = self.db.player_totals(self.member['tag'])
+        self.assertEqual(totals['wars'], 1)
+        self.assertEqual(totals['attacks'], len(made))
+        self.assertEqual(totals['missed'], 2 - len(made))
+        self.assertEqual(totals['stars'], sum(a['stars'] for a in made))
+        attacks = sum(len(member.get('attacks', ()))
+                      for side in ('clan', 'opponent')
+                      for member in self.wardata[side]['members'])
+        self.assertEqual(self.db._db.execute(
+            'SELECT count(*) FROM attack').fetchone(), (attacks,))
+        # Archiving the same war again replaces it rather than adding.
+        self.db.archive_war('W1', self.wardata)
+        self.assertEqual(self.db.player_totals(self.member['tag']), totals)
+
+    def test_a_batch_indexes_every_war_in_it(self):
+        self.db.archive_wars([('W1', self.wardata), ('W2', self.wardata)])
+        totals = self.db.player_totals(self.member['tag'])
+        self.assertEqual(totals['wars'], 2)
+        self.assertEqual(totals['attacks'], 2 * len(self.member['attacks']))
+
+    def test_a_league_war_that_does_not_say_allows_one_attack(self):
+        wardata = dict(self.wardata)
+        wardata.pop('attacksPerMember', None)
+        lone = next(member for member in wardata['clan']['members']
+                    if not member.get('attacks'))
+        self.db.archive_war('L1', wardata, '#LEAGUEWAR')
+        self.db.archive_war('R1', wardata)
+        missed = dict(self.db._db.execute(
+            'SELECT war_id, missed FROM player_war WHERE player_tag = ?',
+            (lone['tag'],)).fetchall())
+        self.assertEqual(missed['L1'], 1)
+        self.assertEqual(missed['R1'], 2)
+
+    def test_a_war_twice_in_one_batch_is_kept_once(self):
+        self.db.archive_wars([('W2', self.wardata), ('W2', self.wardata)])
+        self.assertEqual(self.db.player_totals(self.member['tag'])['wars'], 2)
+        self.assertEqual(self.db.count_wars(), 2)
+
+    def test_the_commands_answer_from_the_index(self):
+        registry.subscribe(self.db, self.clan_tag, 'c1')
+        ctx = commands.Context(db=self.db, monitors={})
+        said = commands.answer(
+            ctx, 'c1', None, f'/player {self.member["tag"][1:]}')[0].text
+        self.assertIn(self.member['name'], said)
+        prepared = self.wardata['preparationStartTime']
+        said = commands.answer(
+            ctx, 'c1', None, f'/top {prepared[:4]}-{prepared[4:6]}')[0].text
+        self.assertIn(self.member['name'], said)
+        self.assertIn('three stars', said)
+        self.assertIn('Town hall lead', said)
+        said = commands.answer(ctx, 'c1', None, '/top 1999-01')[0].text
+        self.assertIn('Nothing archived', said)
+
+    def test_a_player_is_only_shown_to_the_chats_of_their_clan(self):
+        registry.subscribe(self.db, '#ELSEWHERE', 'c2')
+        ctx = commands.Context(db=self.db, monitors={})
+        player = f'/player {self.member["tag"][1:]}'
+        said = commands.answer(ctx, 'c2', None, player)[0].text
+        self.assertIn('No archived war', said)
+        said = commands.answer(ctx, 'dm', None, player)[0].text
+        self.assertIn('No clan followed here', said)
+
+
+class AnalyticsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = Storage(':memory:')
+        self.db.archive_wars([
+            ('W1', load_wardata('warEnded_50.json')),
+            ('W2', load_wardata('cwl_warEnded_mirrored.json'))])
+
+    def tearDown(self):
+        self.db.close()
+
+    def _on_both(self, check):
+        check()
+        with patch('clashogram.analytics.numpy', None):
+            check()
+
+    def test_archive_figures_agree_with_the_index(self):
+        def check():
+            clans = analytics.clan_summary(analytics.archived_players(self.db))
+            for row in clans:
+                totals = self.db._db.execute(
+                    'SELECT sum(attacks), sum(missed), sum(three_stars) '
+                    'FROM player_war WHERE clan_tag = ?',
+                    (row['tag'],)).fetchone()
+                self.assertEqual(
+                    (row['attacks'], row['missed'], row['three_stars']),
+                    totals)
+            rates = analytics.townhall_rates(self.db)
+            self.assertEqual(sum(row['attacks'] for row in rates.values()),
+                             self.db._db.execute(
+                                 'SELECT count(*) FROM attack').fetchone()[0])
+            self.assertEqual(list(rates), sorted(rates))
+        self._on_both(check)
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.warlog = os.path.join(self.tmpdir, 'warlog.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_a_window_covers_the_cycles_asked_for_and_lands_by_the_warlog(self):
+        ctx = commands.Context(db=Storage(':memory:'), monitors={},
+                               admin_id='42')
+        commands.answer(ctx, 'c1', '42', '/profile 2')
+        with profiling.cycle(self.warlog) as first:
+            sum(range(100))
+        self.assertIsNone(first.written)
+        said = commands.answer(ctx, 'c1', '42', '/profile 1')[0].text
+        self.assertIn('Already profiling, 1 cycles to go', said)
+        with profiling.cycle(self.warlog) as second:
+            sum(range(100))
+        self.assertEqual(os.path.dirname(second.written), self.tmpdir)
+        self.assertFalse(profiling.is_running())
+
+    def test_nothing_is_profiled_unless_asked(self):
+        with profiling.cycle(self.warlog) as idle:
+            pass
+        self.assertIsNone(idle.written)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+
+class MemoryTestCase(unittest.TestCase):
+    def test_a_war_shared_with_the_league_is_counted_once(self):
+        warinfo = WarInfo(load_wardata('warEnded_50.json'))
+        leagueinfo = LeagueInfo('#US', {'rounds': []})
+        leagueinfo.wartags['#WAR1'] = warinfo
+        monitor = WarMonitor(Storage(':memory:'), MagicMock(), '#US',
+                             MagicMock())
+        monitor.warinfo, monitor.leagueinfo = warinfo, leagueinfo
+        sizes = memory.monitor_sizes(monitor)
+        self.assertGreater(sizes['war'], 10 * sizes['league'])
+
+    def test_the_operator_sees_each_clan_and_what_grew(self):
+        monitor = WarMonitor(Storage(':memory:'), MagicMock(), '#US',
+                             MagicMock())
+        monitor.warinfo = WarInfo(load_wardata('inWar_40.json'))
+        ctx = commands.Context(db=Storage(':memory:'),
+                               monitors={'#US': monitor}, admin_id='42')
+        self.assertIn('#US war', commands.answer(
+            ctx, 'c1', '42', '/memory')[0].text)
+        try:
+            commands.answer(ctx, 'c1', '42', '/memory trace')
+            self.assertTrue(memory.is_tracing())
+            commands.answer(ctx, 'c1', '42', '/memory trace')
+        finally:
+            commands.answer(ctx, 'c1', '42', '/memory stop')
+        self.assertFalse(memory.is_tracing())
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.cache = LRUCache(2, ttl=60, clock=lambda: self.now)
+
+    def test_a_full_cache_drops_only_the_coldest(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+        self.assertEqual([key in self.cache for key in 'abc'],
+                         [True, False, True])
+        self.assertEqual((self.cache.hits, self.cache.evictions), (1, 1))
+
+    def test_a_stale_entry_is_a_miss(self):
+        self.cache.put('a', 1)
+        self.now = 59
+        self.assertEqual(self.cache.get('a'), 1)
+        self.now = 60
+        self.assertIsNone(self.cache.get('a'))
+        self.assertNotIn('a', self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_clans_and_players_are_asked_for_once(self):
+        api = CoCAPI('token')
+        api._call_api = MagicMock(return_value={'name': 'a'})
+        for _ in range(2):
+            api.get_claninfo('#CLAN')
+            api.get_playerinfo('#PLAYER')
+        self.assertEqual(api._call_api.call_count, 2)
+
+
+class ClanInfoWarmStartTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = Storage(':memory:')
+
+    def _api(self):
+        api = CoCAPI('token', cache=self.db)
+        api._call_api = MagicMock(return_value={'name': 'iran'})
+        return api
+
+    def test_a_restart_starts_from_what_was_saved(self):
+        first = self._api()
+        first.get_claninfo('#CLAN')
+        first.save_claninfo()
+        again = self._api()
+        self.assertEqual(again.get_claninfo('#CLAN').data['name'], 'iran')
+        again._call_api.assert_not_called()
+
+    def test_a_fetch_writes_nothing_until_saved(self):
+        api = self._api()
+        api.get_claninfo('#CLAN')
+        self.assertEqual(self.db.fresh_claninfo(0), [])
+        api.save_claninfo()
+        self.assertEqual([row[0] for row in self.db.fresh_claninfo(0)],
+                         ['#CLAN'])
+
+    def test_a_restart_longer_than_the_ttl_still_warms(self):
+        with patch('clashogram.api.time.time', return_value=1000):
+            first = self._api()
+            first.get_claninfo('#CLAN')
+            first.save_claninfo()
+        with patch('clashogram.api.time.time', return_value=1000 + 600):
+            again = self._api()
+        again.get_claninfo('#CLAN')
+        again._call_api.assert_not_called()
+
+    def test_old_details_are_fetched_and_pruned_on_save(self):
+        with patch('clashogram.api.time.time', return_value=1000):
+            first = self._api()
+            first.get_claninfo('#OLD')
+            first.save_claninfo()
+        with patch('clashogram.api.time.time',
+                   return_value=1000 + CLANINFO_KEEP + 1):
+            again = self._api()
+            again.get_claninfo('#NEW')
+            again.save_claninfo()
+            self.assertEqual([row[0] for row in self.db.fresh_claninfo(0)],
+                             ['#NEW'])
+            later = self._api()
+            later.get_claninfo('#OLD')
+        later._call_api.assert_called_once()
+
+
+class CodecTestCase(unittest.TestCase):
+    def test_every_decoder_reads_bytes_and_str_alike(self):
+        with open(os.path.join('data', 'cwl_warEnded_mirrored.json'),
+                  'rb') as fixture:
+            raw = fixture.read()
+        expected = json.loads(raw.decode('utf-8'))
+        for name, decode in codec.DECODERS.items():
+            self.assertEqual(decode(raw), expected, name)
+            self.assertEqual(decode(raw.decode('utf-8')), expected, name)
+
+
 if __name__ == '__main__':
     unittest.main()